@@ -0,0 +1,202 @@
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from os import path
+from tempfile import TemporaryDirectory
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+import loader
+from bootstrap import bootstrap_dprime_slope
+from confusion import ConfusionMatrix
+from models import ParticipantException
+from rmcorr import get_rmcorr_for_sensitivities_by_participant
+from sensitivity import get_interstim_sensitivities_for_confusion_matrix
+from study import Study
+from synthetic import write_synthetic_study
+
+default_sizes = (10, 100, 1000, 10000, 100000)
+sectors = ("left", "center", "right")
+
+# Stages that scale badly are skipped above these participant counts unless overridden
+default_stage_limits = {}
+
+
+def _measure(run, trace_memory):
+    # Times one call of `run`, then repeats it under tracemalloc to get its peak allocation so
+    # that tracing overhead doesn't leak into the timings
+    start = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - start
+    peak_bytes = None
+    if trace_memory:
+        tracemalloc.start()
+        run()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, {"seconds": seconds, "peak_bytes": peak_bytes}
+
+
+def _parse(data_file_paths, metadata_by_pid):
+    participants = []
+    exceptions = []
+    for file_path in data_file_paths:
+        try:
+            participants.append(loader.get_participant_for_file(file_path, metadata_by_pid))
+        except ParticipantException as ex:
+            exceptions.append(ex)
+    return Study(participants, exceptions)
+
+
+def _parse_columnar(data_file_paths, metadata_by_pid):
+    results = loader.get_participants_for_files(data_file_paths, metadata_by_pid)
+    participants = [r for r in results if not isinstance(r, ParticipantException)]
+    exceptions = [r for r in results if isinstance(r, ParticipantException)]
+    return Study(participants, exceptions)
+
+
+def _get_confusion_matrices(participants):
+    return [
+        ConfusionMatrix.of_azimuths(participant.get_responses(sector))
+        for participant in participants
+        for sector in sectors
+    ]
+
+
+def _get_sensitivities(matrices):
+    return [get_interstim_sensitivities_for_confusion_matrix(cm) for cm in matrices]
+
+
+def run_benchmarks(
+    data_file_paths,
+    metadata_file_paths,
+    sizes=default_sizes,
+    iterations=1000,
+    stage_limits=default_stage_limits,
+    trace_memory=True,
+):
+    metadata_by_pid = loader.load_participant_metadata(metadata_file_paths)
+    results = []
+
+    def record(stage, size, run):
+        limit = stage_limits.get(stage)
+        if limit is not None and size > limit:
+            results.append({"stage": stage, "participants": size, "skipped": True})
+            return None
+        try:
+            value, measurement = _measure(run, trace_memory)
+        except Exception as ex:
+            results.append({"stage": stage, "participants": size, "error": repr(ex)})
+            print(f"{stage:>14} n={size:<7} failed: {ex!r}")
+            return None
+        results.append({"stage": stage, "participants": size, **measurement})
+        print(f"{stage:>14} n={size:<7} {measurement['seconds']:.3f}s")
+        return value
+
+    for size in sizes:
+        paths = data_file_paths[:size]
+        record("parse", size, lambda: _parse(paths, metadata_by_pid))
+        study = record("parse-columnar", size, lambda: _parse_columnar(paths, metadata_by_pid))
+        if study is None:
+            continue
+        participants = study.get()
+        matrices = record("confusion", size, lambda: _get_confusion_matrices(participants))
+        if matrices is None:
+            continue
+        sensitivities = record("sensitivities", size, lambda: _get_sensitivities(matrices))
+        center_matrices = matrices[1::3]
+        record(
+            "bootstrap",
+            size,
+            lambda: bootstrap_dprime_slope(
+                center_matrices, iterations=iterations, rng=np.random.default_rng(0)
+            ),
+        )
+        if sensitivities is not None:
+            record(
+                "rmcorr",
+                size,
+                lambda: get_rmcorr_for_sensitivities_by_participant(sensitivities[1::3]),
+            )
+    return results
+
+
+def _get_commit():
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=path.dirname(path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def compare_results(previous, current):
+    previous_seconds = {
+        (r["stage"], r["participants"]): r["seconds"] for r in previous["results"] if "seconds" in r
+    }
+    print(f"Compared with {previous.get('commit')}:")
+    for result in current["results"]:
+        key = (result["stage"], result["participants"])
+        if "seconds" in result and key in previous_seconds:
+            ratio = result["seconds"] / previous_seconds[key]
+            print(f"{key[0]:>14} n={key[1]:<7} {ratio:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the analysis stages on synthetic studies")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(default_sizes))
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="Previous results JSON to compare with")
+    parser.add_argument("--no-memory", action="store_true", help="Skip peak memory tracing")
+    parser.add_argument(
+        "--stage-limit",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("STAGE", "PARTICIPANTS"),
+        help="Skip STAGE above PARTICIPANTS participants",
+    )
+    args = parser.parse_args()
+    stage_limits = {
+        **default_stage_limits,
+        **{stage: int(limit) for stage, limit in args.stage_limit},
+    }
+
+    with TemporaryDirectory() as work_dir:
+        # Sizes share one generated study; each size reads the first n files
+        data_file_paths, metadata_file_paths = write_synthetic_study(
+            work_dir, max(args.sizes), seed=args.seed
+        )
+        results = run_benchmarks(
+            data_file_paths,
+            metadata_file_paths,
+            sizes=sorted(args.sizes),
+            iterations=args.iterations,
+            stage_limits=stage_limits,
+            trace_memory=not args.no_memory,
+        )
+
+    output = {
+        "commit": _get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "iterations": args.iterations,
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as file:
+            compare_results(json.load(file), output)
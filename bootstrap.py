@@ -1,71 +1,387 @@
-from typing import List, Tuple
-import itertools
+from dataclasses import dataclass
+from itertools import combinations
+from typing import List, Optional, Union
 
 import numpy as np
-import pandas as pd
-from statsmodels.formula.api import ols
 from scipy.stats import linregress
 
 
 from confusion import ConfusionMatrix
-from sensitivity import get_interstim_sensitivities_for_confusion_matrix, InterstimSensitivities
-from rmcorr import get_rmcorr_for_sensitivities_by_participant
+from profiling import stage, timed
+from sensitivity import get_interstim_sensitivity_arrays
+from rmcorr import get_rmcorr_for_sensitivity_arrays, get_batched_rmcorr
 
 rng = np.random.default_rng(8675309)
 
+Matrices = Union[List[ConfusionMatrix], np.ndarray]
 
-def _get_slope_for_sensitivites_by_participant(
-    sensitivities_by_participant: List[List[InterstimSensitivities]],
-):
-    flattened_sensitivities = itertools.chain(*sensitivities_by_participant)
-    x, y = zip(*flattened_sensitivities)
-    linreg = linregress(x, y)
+# Percentiles reported as the CI endpoints
+lower_percentile = 0.025
+upper_percentile = 100 - lower_percentile
+
+
+@dataclass
+class BootstrapConvergence:
+    iterations: int
+    mc_error: float
+
+
+def _resolve_rng(generator):
+    return rng if generator is None else generator
+
+
+def _get_slope_for_sensitivity_arrays(distances: np.ndarray, dprimes: np.ndarray):
+    linreg = linregress(distances.ravel(), dprimes.ravel())
     return linreg.slope, linreg.intercept
 
 
-def _get_rmcorr_slope_for_sensitivities_by_participant(
-    sensitivities_by_participant: List[List[InterstimSensitivities]],
+def _get_rmcorr_slope_for_sensitivity_arrays(distances: np.ndarray, dprimes: np.ndarray):
+    slope, *_ = get_rmcorr_for_sensitivity_arrays(distances, dprimes)
+    return slope, None
+
+
+def _get_batched_slopes(distances: np.ndarray, dprimes: np.ndarray):
+    # Pooled least-squares slope over every (subject, pair) point of each sample
+    x = distances.reshape(*distances.shape[:-2], -1)
+    y = dprimes.reshape(*dprimes.shape[:-2], -1)
+    x = x - x.mean(axis=-1, keepdims=True)
+    y = y - y.mean(axis=-1, keepdims=True)
+    return np.einsum("...i,...i->...", x, y) / np.einsum("...i,...i->...", x, x)
+
+
+def _get_totals(matrices: Matrices):
+    # Accepts either a list of ConfusionMatrix or a (participants x k x k) tensor of totals
+    if isinstance(matrices, np.ndarray):
+        return matrices
+    return np.stack([cm.totals for cm in matrices])
+
+
+def _get_sensitivity_arrays(matrices: Matrices):
+    return get_interstim_sensitivity_arrays(_get_totals(matrices))
+
+
+@dataclass
+class ResamplingPlan:
+    # Participant indices for every resample, (iterations x sample_size). Drawing these once per
+    # condition and reusing them across sectors and statistics gives paired resamples.
+    num_participants: int
+    indices: np.ndarray
+
+    @staticmethod
+    def draw(num_participants: int, sample_size=12, iterations=10000, rng=None):
+        # The same draws as calling rng.choice(sensitivities, sample_size) once per iteration
+        indices = _resolve_rng(rng).choice(num_participants, (iterations, sample_size))
+        return ResamplingPlan(num_participants, indices)
+
+    @property
+    def iterations(self):
+        return self.indices.shape[0]
+
+    @property
+    def sample_size(self):
+        return self.indices.shape[1]
+
+    def gather(self, distances: np.ndarray, dprimes: np.ndarray, start=0, stop=None):
+        # (iterations, sample_size, pairs) arrays for resamples start:stop
+        if len(dprimes) != self.num_participants:
+            raise ValueError(
+                f"Plan is for {self.num_participants} participants, got {len(dprimes)}"
+            )
+        indices = self.indices[start:stop]
+        return np.take(distances, indices, axis=0), np.take(dprimes, indices, axis=0)
+
+
+def _get_resampler(
+    distances: np.ndarray,
+    dprimes: np.ndarray,
+    sample_size: int,
+    rng: np.random.Generator,
+    plan: Optional[ResamplingPlan],
 ):
-    slope, *_ = get_rmcorr_for_sensitivities_by_participant(sensitivities_by_participant)
-    return slope
+    # Returns a function giving the next `size` resamples, from the plan if there is one
+    drawn = 0
+
+    def resample(size):
+        nonlocal drawn
+        if plan is None:
+            batch_plan = ResamplingPlan.draw(len(dprimes), sample_size, size, rng)
+            return batch_plan.gather(distances, dprimes)
+        drawn += size
+        return plan.gather(distances, dprimes, drawn - size, drawn)
+
+    return resample
+
+
+def get_percentile_mc_error(sorted_values: np.ndarray, percentile: float):
+    # Monte-Carlo standard error of a percentile estimate. The rank of the sample quantile is
+    # binomial, so the order statistics one binomial standard deviation either side of it span
+    # roughly two standard errors. Until the sample reaches past both of those ranks the error
+    # can't be estimated, and is reported as infinite.
+    n = len(sorted_values)
+    q = percentile / 100
+    position = q * (n - 1)
+    spread = np.sqrt(n * q * (1 - q))
+    lower = int(np.floor(position - spread))
+    upper = int(np.ceil(position + spread))
+    if lower < 0 or upper > n - 1:
+        return np.inf
+    return (sorted_values[upper] - sorted_values[lower]) / 2
+
+
+def _get_ci_mc_error(statistics):
+    return max(
+        get_percentile_mc_error(np.sort(values), percentile)
+        for values in statistics
+        for percentile in (lower_percentile, upper_percentile)
+    )
+
+
+def _run_adaptive(run_batch, tolerance: float, batch_size: int, max_iterations: int):
+    # Calls run_batch(size) for tuples of per-resample statistics until the MC error of every
+    # CI endpoint is within tolerance, or max_iterations resamples have been drawn
+    batches = []
+    iterations = 0
+    while True:
+        size = min(batch_size, max_iterations - iterations)
+        batches.append(run_batch(size))
+        iterations += size
+        statistics = [np.concatenate(values) for values in zip(*batches)]
+        mc_error = _get_ci_mc_error(statistics)
+        if mc_error <= tolerance or iterations >= max_iterations:
+            return statistics, BootstrapConvergence(iterations, float(mc_error))
+
+
+def _run_fixed(run_batch, iterations: int):
+    return run_batch(iterations), None
+
+
+def _get_run_adaptive(tolerance: float, batch_size: int, max_iterations: int):
+    def run(run_batch, iterations):
+        return _run_adaptive(run_batch, tolerance, batch_size, min(max_iterations, iterations))
+
+    return run
+
+
+def _bootstrap_slopes(matrices: Matrices, sample_size, iterations, use_rmcorr, rng, plan, run):
+    rng = _resolve_rng(rng)
+    if plan is not None:
+        iterations = plan.iterations
+    get_slope = (
+        _get_rmcorr_slope_for_sensitivity_arrays
+        if use_rmcorr
+        else _get_slope_for_sensitivity_arrays
+    )
+    distances, dprimes = _get_sensitivity_arrays(matrices)
+    overall_slope, overall_intercept = get_slope(distances, dprimes)
+
+    resample = _get_resampler(distances, dprimes, sample_size, rng, plan)
+
+    def run_batch(size):
+        with stage("bootstrap.batch"):
+            sample_distances, sample_dprimes = resample(size)
+            if use_rmcorr:
+                slopes, _ = get_batched_rmcorr(sample_distances, sample_dprimes)
+            else:
+                slopes = _get_batched_slopes(sample_distances, sample_dprimes)
+            return (slopes,)
 
+    (slopes,), convergence = run(run_batch, iterations)
+    return (overall_slope, overall_intercept), np.sort(slopes).tolist(), convergence
 
+
+@timed("bootstrap.slope")
 def bootstrap_dprime_slope(
-    matrices: List[ConfusionMatrix],
+    matrices: Matrices,
     sample_size=12,
     iterations=10000,
     use_rmcorr=False,
+    rng=None,
+    plan: Optional[ResamplingPlan] = None,
 ):
-    get_slope = (
-        _get_rmcorr_slope_for_sensitivities_by_participant
-        if use_rmcorr
-        else _get_slope_for_sensitivites_by_participant
+    # A plan, if given, supplies the resamples instead of rng
+    overall, slopes, _ = _bootstrap_slopes(
+        matrices, sample_size, iterations, use_rmcorr, rng, plan, _run_fixed
+    )
+    return overall, slopes
+
+
+@timed("bootstrap.slope")
+def bootstrap_dprime_slope_adaptive(
+    matrices: Matrices,
+    tolerance: float,
+    sample_size=12,
+    max_iterations=10000,
+    use_rmcorr=False,
+    rng=None,
+    batch_size=1000,
+    plan: Optional[ResamplingPlan] = None,
+):
+    # As bootstrap_dprime_slope, but drawing resamples batch_size at a time until the MC error of
+    # both CI endpoints is within tolerance (at most max_iterations, or the plan's resamples), and
+    # returning a BootstrapConvergence as a third value. The endpoints are the 0.025th and
+    # 99.975th percentiles, whose error can't be estimated from fewer than about 4,000 resamples
+    # (see get_percentile_mc_error), so no run stops before then: with the default batch size,
+    # the earliest is after 5,000.
+    return _bootstrap_slopes(
+        matrices,
+        sample_size,
+        max_iterations,
+        use_rmcorr,
+        rng,
+        plan,
+        _get_run_adaptive(tolerance, batch_size, max_iterations),
     )
-    sensitivities = [get_interstim_sensitivities_for_confusion_matrix(cm) for cm in matrices]
-    overall_slope, overall_intercept = get_slope(sensitivities)
-    slopes = []
-    r2s = []
-    for i in range(iterations):
-        psuedosample_sensitivities = rng.choice(sensitivities, sample_size)
-        slope, _ = get_slope(psuedosample_sensitivities)
-        slopes.append(slope)
-    return (overall_slope, overall_intercept), list(sorted(slopes))
 
 
 def percentiles(values):
-    lower = np.percentile(values, 0.025)
+    lower = np.percentile(values, lower_percentile)
     median = np.median(values)
-    upper = np.percentile(values, 100 - 0.025)
+    upper = np.percentile(values, upper_percentile)
     return (lower, median, upper)
 
 
-def bootstrap_dprime_rmcorr_ci95(matrices: List[ConfusionMatrix], sample_size=12, iterations=10000):
-    sensitivities = [get_interstim_sensitivities_for_confusion_matrix(cm) for cm in matrices]
-    slopes = []
-    rm_corrs = []
-    for i in range(iterations):
-        psuedosample_sensitivities = rng.choice(sensitivities, sample_size)
-        slope, rm_corr, *_ = get_rmcorr_for_sensitivities_by_participant(psuedosample_sensitivities)
-        slopes.append(slope)
-        rm_corrs.append(rm_corr)
-    return percentiles(slopes), percentiles(rm_corrs)
+def _bootstrap_rmcorr_ci95(matrices: Matrices, sample_size, iterations, rng, plan, run):
+    rng = _resolve_rng(rng)
+    if plan is not None:
+        iterations = plan.iterations
+    distances, dprimes = _get_sensitivity_arrays(matrices)
+    resample = _get_resampler(distances, dprimes, sample_size, rng, plan)
+
+    def run_batch(size):
+        with stage("bootstrap.batch"):
+            return get_batched_rmcorr(*resample(size))
+
+    (slopes, rm_corrs), convergence = run(run_batch, iterations)
+    return percentiles(slopes), percentiles(rm_corrs), convergence
+
+
+@timed("bootstrap.rmcorr_ci95")
+def bootstrap_dprime_rmcorr_ci95(
+    matrices: Matrices,
+    sample_size=12,
+    iterations=10000,
+    rng=None,
+    plan: Optional[ResamplingPlan] = None,
+):
+    # Resampled by plan if given, as for bootstrap_dprime_slope
+    slope_ci95, rm_corr_ci95, _ = _bootstrap_rmcorr_ci95(
+        matrices, sample_size, iterations, rng, plan, _run_fixed
+    )
+    return slope_ci95, rm_corr_ci95
+
+
+@timed("bootstrap.rmcorr_ci95")
+def bootstrap_dprime_rmcorr_ci95_adaptive(
+    matrices: Matrices,
+    tolerance: float,
+    sample_size=12,
+    max_iterations=10000,
+    rng=None,
+    batch_size=1000,
+    plan: Optional[ResamplingPlan] = None,
+):
+    # Stops adaptively, as bootstrap_dprime_slope_adaptive does, returning a
+    # BootstrapConvergence as a third value
+    return _bootstrap_rmcorr_ci95(
+        matrices,
+        sample_size,
+        max_iterations,
+        rng,
+        plan,
+        _get_run_adaptive(tolerance, batch_size, max_iterations),
+    )
+
+
+@dataclass
+class PermutationTestResult:
+    # Difference in rmcorr slope (first group minus second) and its permutation null
+    observed: float
+    pval: float
+    null_distribution: np.ndarray
+
+
+def _get_subject_moments(distances: np.ndarray, dprimes: np.ndarray):
+    # Per-subject sums whose ratio, summed over any group of subjects, is that group's rmcorr slope
+    x = distances - distances.mean(axis=-1, keepdims=True)
+    y = dprimes - dprimes.mean(axis=-1, keepdims=True)
+    return np.einsum("sp,sp->s", x, y), np.einsum("sp,sp->s", x, x)
+
+
+def _draw_permutation_masks(num_first: int, num_total: int, permutations: int, rng):
+    # Row i marks the participants relabeled into the first group by permutation i
+    ranks = rng.random((permutations, num_total)).argsort(axis=1)
+    return ranks < num_first
+
+
+def _get_slope_differences(sxy: np.ndarray, sxx: np.ndarray, masks: np.ndarray):
+    first = masks.astype(float)
+    second = 1 - first
+    return first @ sxy / (first @ sxx) - second @ sxy / (second @ sxx)
+
+
+@timed("bootstrap.permutation_test")
+def permutation_test_dprime_rmcorr_slope(
+    first: Matrices,
+    second: Matrices,
+    permutations=10000,
+    rng=None,
+    masks: Optional[np.ndarray] = None,
+):
+    # Two-sided test of equal rmcorr slopes, shuffling group labels across the pooled participants
+    distances, dprimes = _get_sensitivity_arrays(
+        np.concatenate([_get_totals(first), _get_totals(second)])
+    )
+    num_first = len(first)
+    if masks is None:
+        masks = _draw_permutation_masks(num_first, len(dprimes), permutations, _resolve_rng(rng))
+    sxy, sxx = _get_subject_moments(distances, dprimes)
+    observed_mask = np.arange(len(dprimes)) < num_first
+    (observed,) = _get_slope_differences(sxy, sxx, observed_mask[None])
+    null_distribution = _get_slope_differences(sxy, sxx, masks)
+    count = np.count_nonzero(np.abs(null_distribution) >= np.abs(observed))
+    return PermutationTestResult(
+        observed=float(observed),
+        pval=float((count + 1) / (len(masks) + 1)),
+        null_distribution=null_distribution,
+    )
+
+
+def permutation_test_conditions(
+    first,
+    second,
+    sectors=("left", "center", "right"),
+    permutations=10000,
+    rng=None,
+):
+    # Tests two Conditions sector by sector, with the same relabelings for every sector
+    first_participants = first.get()
+    second_participants = second.get()
+    masks = _draw_permutation_masks(
+        len(first_participants),
+        len(first_participants) + len(second_participants),
+        permutations,
+        _resolve_rng(rng),
+    )
+    return {
+        sector: permutation_test_dprime_rmcorr_slope(
+            ConfusionMatrix.stack_of_participants(first_participants, sector),
+            ConfusionMatrix.stack_of_participants(second_participants, sector),
+            masks=masks,
+        )
+        for sector in sectors
+    }
+
+
+def permutation_test_condition_pairs(
+    conditions,
+    sectors=("left", "center", "right"),
+    permutations=10000,
+    rng=None,
+):
+    # Runs permutation_test_conditions on every pair, e.g. of the cells from Study.subsect
+    rng = _resolve_rng(rng)
+    return [
+        (first, second, permutation_test_conditions(first, second, sectors, permutations, rng))
+        for first, second in combinations(conditions, 2)
+        if first.count() and second.count()
+    ]
@@ -0,0 +1,237 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from os import makedirs, path
+import hashlib
+import pickle
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import numpy as np
+
+from confusion import ConfusionMatrix
+from fitting import fit_lin, get_padded_arrays
+from sensitivity import get_interstim_sensitivity_arrays, get_lin, get_linspace_for_sensitivities
+from util import atomic_output_path, read_json, write_json
+
+output_dir = path.normpath(path.join(__file__, "..", "figures"))
+manifest_filename = "manifest.json"
+sectors = ("left", "center", "right")
+formats = ("png", "pdf")
+# Bump to rebuild every figure after changing how they're drawn
+render_version = 1
+
+
+def get_condition_mean_confusions(conditions, kind="azimuths"):
+    # Mean confusion totals of every condition from one stacked tensor of all their participants,
+    # reduced per condition with a single np.add.reduceat
+    counts = np.array([condition.count() for condition in conditions])
+    if np.any(counts == 0):
+        raise ValueError("Cannot average the confusion matrices of an empty condition")
+    participants = [participant for condition in conditions for participant in condition.get()]
+    totals = ConfusionMatrix.stack_of_participants(participants, kind=kind)
+    starts = np.cumsum(counts) - counts
+    return np.add.reduceat(totals, starts, axis=0) / counts[:, None, None]
+
+
+def _get_confusion_spec(name, title, conditions, label_fields):
+    conditions = [condition for condition in conditions if condition.count()]
+    return {
+        "name": name,
+        "kind": "confusion",
+        "title": title,
+        "labels": [
+            f"{condition.label(*label_fields)} (n={condition.count()})" for condition in conditions
+        ],
+        "matrices": get_condition_mean_confusions(conditions),
+    }
+
+
+def _get_sensitivity_spec(name, title, conditions_by_row, row_labels, label_fields):
+    # Per row, sector and condition: the scattered (distance, d') points and their linear fit,
+    # with the fits of every panel solved in one batched call
+    panels = []
+    samples = []
+    for row_label, conditions in zip(row_labels, conditions_by_row):
+        for sector in sectors:
+            for condition in conditions:
+                if not condition.count():
+                    continue
+                totals = ConfusionMatrix.stack_of_participants(condition.get(), sector)
+                distances, d_primes = get_interstim_sensitivity_arrays(totals)
+                sample = list(zip(distances.ravel().tolist(), d_primes.ravel().tolist()))
+                samples.append(sample)
+                panels.append(
+                    {
+                        "row": row_label,
+                        "sector": sector,
+                        "label": condition.label(*label_fields),
+                        "points": np.array(sample),
+                        "fit_x": get_linspace_for_sensitivities(sample),
+                    }
+                )
+    params, _ = fit_lin(*get_padded_arrays(samples))
+    for panel, (m_param, b_param) in zip(panels, params):
+        panel["fit_y"] = get_lin(panel["fit_x"], m_param, b_param)
+    return {
+        "name": name,
+        "kind": "sensitivities",
+        "title": title,
+        "rows": list(row_labels),
+        "panels": panels,
+    }
+
+
+def get_figure_specs(study):
+    specs = []
+    for slowdown in (12, 20):
+        conditions = study.subsect(slowdown=slowdown, compensation=[1, slowdown // 2, slowdown])
+        specs.append(
+            _get_confusion_spec(
+                f"confusion_s{slowdown}",
+                f"Inter-position confusion (slowdown={slowdown})",
+                conditions,
+                ["compensation"],
+            )
+        )
+    specs.append(
+        _get_confusion_spec(
+            "confusion_spherical_vs_kemar",
+            "Simulated spherical head model vs. KEMAR model (slowdown=20)",
+            study.spherical_vs_kemar(compensation=20, slowdown=20),
+            ["model_name"],
+        )
+    )
+    specs.append(
+        _get_sensitivity_spec(
+            "sensitivities",
+            "Interstimulus sensitivity by sector",
+            [
+                study.subsect(slowdown=slowdown, compensation_descriptor=["1", "half", "full"])
+                for slowdown in (12, 20)
+            ],
+            ["S=12", "S=20"],
+            ["compensation_descriptor"],
+        )
+    )
+    return specs
+
+
+def get_spec_hash(spec):
+    # Pickle is deterministic for the dicts, lists, strings and arrays that make up a spec
+    digest = hashlib.sha256(pickle.dumps((render_version, spec), protocol=4))
+    return digest.hexdigest()
+
+
+def _render_confusion(spec):
+    import matplotlib.pyplot as plt
+
+    count = len(spec["matrices"])
+    fig, axes = plt.subplots(nrows=1, ncols=count, figsize=(6 * count, 6), squeeze=False)
+    fig.suptitle(spec["title"], size=20)
+    for axis, label, matrix in zip(axes[0], spec["labels"], spec["matrices"]):
+        axis.set_title(label)
+        axis.imshow(matrix, extent=[-90, 90, -90, 90])
+        axis.set_xlabel("Reported azimuth (degrees)")
+        axis.set_ylabel("True azimuth (degrees)")
+    return fig
+
+
+def _render_sensitivities(spec):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+
+    rows = spec["rows"]
+    fig, axes = plt.subplots(
+        nrows=len(rows), ncols=len(sectors), figsize=(15, 5 * len(rows)), sharey=True, squeeze=False
+    )
+    fig.suptitle(spec["title"], size=20)
+    labels = sorted({panel["label"] for panel in spec["panels"]})
+    colors = dict(zip(labels, plt.cm.rainbow(np.linspace(0, 1, len(labels)))))
+    for panel in spec["panels"]:
+        ax = axes[rows.index(panel["row"]), sectors.index(panel["sector"])]
+        color = colors[panel["label"]]
+        ax.plot(panel["fit_x"], panel["fit_y"], color=color, label=panel["label"])
+        ax.plot(*panel["points"].T, color=color, marker=".", linestyle="None")
+    for row_index, row in enumerate(rows):
+        for sector_index, sector in enumerate(sectors):
+            ax = axes[row_index, sector_index]
+            if row_index == 0:
+                ax.set_title(sector.capitalize(), fontsize=15)
+            ax.xaxis.set_major_formatter(ticker.FuncFormatter(lambda t, pos: f"{int(10*t)}"))
+            ax.set_xticks(range(1, 6))
+            ax.set_xlabel("Stimulus separation (degrees)")
+            ax.set_ylabel(f"d' ({row})", fontsize=15)
+            ax.legend(loc="lower right")
+    return fig
+
+
+renderers = {"confusion": _render_confusion, "sensitivities": _render_sensitivities}
+
+
+def render_figure(spec, figure_dir=output_dir, figure_formats=formats):
+    import matplotlib.pyplot as plt
+
+    fig = renderers[spec["kind"]](spec)
+    for figure_format in figure_formats:
+        figure_path = path.join(figure_dir, f"{spec['name']}.{figure_format}")
+        # savefig picks the format from the extension
+        with atomic_output_path(figure_path, f".tmp.{figure_format}") as temp_path:
+            fig.savefig(temp_path)
+    plt.close(fig)
+    return spec["name"]
+
+
+def build_figures(study, figure_dir=output_dir, workers=None, force=False, figure_formats=formats):
+    # Renders the figures whose input data changed since the last build, on a process pool, and
+    # returns the names of those rendered
+    makedirs(figure_dir, exist_ok=True)
+    manifest_path = path.join(figure_dir, manifest_filename)
+    manifest = read_json(manifest_path) or {}
+    specs = get_figure_specs(study)
+    hashes = {spec["name"]: get_spec_hash(spec) for spec in specs}
+    stale = [
+        spec
+        for spec in specs
+        if force
+        or manifest.get(spec["name"]) != hashes[spec["name"]]
+        or not all(
+            path.exists(path.join(figure_dir, f"{spec['name']}.{figure_format}"))
+            for figure_format in figure_formats
+        )
+    ]
+    rendered = []
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                render_figure,
+                stale,
+                [figure_dir] * len(stale),
+                [figure_formats] * len(stale),
+            )
+            for name in results:
+                rendered.append(name)
+                manifest[name] = hashes[name]
+    write_json(manifest_path, manifest)
+    return rendered
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Render the paper figures")
+    parser.add_argument("--output", default=output_dir)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--force", action="store_true", help="Render every figure")
+    parser.add_argument("--format", choices=formats, nargs="+", default=list(formats))
+    args = parser.parse_args()
+
+    from loader import echo_study
+
+    rendered = build_figures(
+        echo_study,
+        figure_dir=args.output,
+        workers=args.workers,
+        force=args.force,
+        figure_formats=tuple(args.format),
+    )
+    print(f"Rendered {len(rendered)} figures: {', '.join(rendered) or 'none'}")
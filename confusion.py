@@ -1,8 +1,28 @@
-from typing import List, Tuple
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple, Union
 from statistics import NormalDist
 import numpy as np
 
-from models import Response, Participant
+from models import Response, ResponseTable, Participant
+from profiling import timed
+
+
+def _get_label_indices(labels: np.ndarray, values: np.ndarray):
+    order = np.argsort(labels, kind="stable")
+    positions = np.searchsorted(labels, values, sorter=order)
+    indices = order[np.minimum(positions, len(labels) - 1)]
+    missing = labels[indices] != values
+    if np.any(missing):
+        raise ValueError(f"{values[missing][0]} is not in labels")
+    return indices
+
+
+def _get_response_arrays(responses, true_field: str, reported_field: str):
+    if isinstance(responses, ResponseTable):
+        return getattr(responses, true_field), getattr(responses, reported_field)
+    true = np.array([getattr(r, true_field) for r in responses], dtype=int)
+    reported = np.array([getattr(r, reported_field) for r in responses], dtype=int)
+    return true, reported
 
 
 class ConfusionMatrix:
@@ -43,45 +63,181 @@ class ConfusionMatrix:
 
     @staticmethod
     def from_true_reported_pairs(true_reported_pairs: List[Tuple[int, int]], provided_labels=None):
+        pairs = np.array(true_reported_pairs, dtype=int).reshape(-1, 2)
+        return ConfusionMatrix.from_true_reported_arrays(pairs[:, 0], pairs[:, 1], provided_labels)
+
+    @staticmethod
+    @timed("confusion.from_arrays")
+    def from_true_reported_arrays(true: np.ndarray, reported: np.ndarray, provided_labels=None):
+        true = np.asarray(true, dtype=int)
+        reported = np.asarray(reported, dtype=int)
         if provided_labels:
-            labels = provided_labels
+            labels = list(provided_labels)
         else:
-            extracted_labels = set()
-            for (true, reported) in true_reported_pairs:
-                extracted_labels.add(true)
-                extracted_labels.add(reported)
-            labels = list(sorted(extracted_labels))
+            labels = np.union1d(true, reported).tolist()
         size = len(labels)
-        matrix = np.zeros((size, size))
-        for (true, reported) in true_reported_pairs:
-            true_index = labels.index(true)
-            reported_index = labels.index(reported)
-            matrix[true_index, reported_index] += 1
-        return ConfusionMatrix(matrix, labels)
+        label_array = np.asarray(labels)
+        true_index = _get_label_indices(label_array, true)
+        reported_index = _get_label_indices(label_array, reported)
+        counts = np.bincount(true_index * size + reported_index, minlength=size * size)
+        return ConfusionMatrix(counts.reshape(size, size).astype(float), labels)
 
     @staticmethod
-    def of_azimuths(responses: List[Response]):
-        min_azimuth = float("inf")
-        max_azimuth = float("-inf")
-        for resp in responses:
-            for az in (resp.true_azimuth, resp.response_azimuth):
-                min_azimuth = min(min_azimuth, az)
-                max_azimuth = max(max_azimuth, az)
+    def of_azimuths(responses: Union[List[Response], ResponseTable]):
+        true, reported = _get_response_arrays(responses, "true_azimuth", "response_azimuth")
+        min_azimuth = int(min(true.min(), reported.min()))
+        max_azimuth = int(max(true.max(), reported.max()))
         labels = list(range(min_azimuth, max_azimuth + 10, 10))
-        return ConfusionMatrix.from_true_reported_pairs(
-            [(r.true_azimuth, r.response_azimuth) for r in responses], labels
-        )
+        return ConfusionMatrix.from_true_reported_arrays(true, reported, labels)
+
+    @staticmethod
+    def of_indices(responses: Union[List[Response], ResponseTable]):
+        true, reported = _get_response_arrays(responses, "true_index", "response_index")
+        return ConfusionMatrix.from_true_reported_arrays(true, reported)
 
     @staticmethod
-    def of_indices(responses: List[Response]):
-        return ConfusionMatrix.from_true_reported_pairs(
-            [(r.true_index, r.response_index) for r in responses]
-        )
+    @timed("confusion.stack_of_participants")
+    def stack_of_participants(participants: List[Participant], sector=None, kind="indices"):
+        # Returns a (participants x size x size) tensor of totals, one of_indices or of_azimuths
+        # matrix per participant, built with a single bincount over their concatenated responses
+        tables = [participant.get_table(sector) for participant in participants]
+        lengths = np.array([len(table) for table in tables], dtype=int)
+        if np.any(lengths == 0):
+            raise ValueError("Cannot build a confusion matrix for a participant without responses")
+        table = ResponseTable.concatenate(tables)
+        positions = np.repeat(np.arange(len(tables)), lengths)
+        if kind == "indices":
+            true = table.true_index.astype(int)
+            reported = table.response_index.astype(int)
+            size = table.azimuth_choices.shape[1]
+            if np.any(true < 0) or np.any(reported < 0):
+                raise ValueError("Responses include azimuths that are not among their choices")
+        elif kind == "azimuths":
+            starts = np.cumsum(lengths) - lengths
+            lowest = np.minimum(table.true_azimuth, table.response_azimuth).astype(int)
+            highest = np.maximum(table.true_azimuth, table.response_azimuth).astype(int)
+            min_azimuths = np.minimum.reduceat(lowest, starts)
+            max_azimuths = np.maximum.reduceat(highest, starts)
+            sizes = (max_azimuths - min_azimuths) // 10 + 1
+            if np.any(sizes != sizes[0]):
+                raise ValueError("Participants' azimuth ranges differ in size")
+            size = int(sizes[0])
+            offsets = min_azimuths[positions]
+            true = table.true_azimuth - offsets
+            reported = table.response_azimuth - offsets
+            if np.any(true % 10) or np.any(reported % 10):
+                raise ValueError("Responses include azimuths that are not 10 degrees apart")
+            true, reported = true // 10, reported // 10
+        else:
+            raise ValueError(f"Unknown confusion matrix kind {kind}")
+        flat = (positions * size + true) * size + reported
+        counts = np.bincount(flat, minlength=len(tables) * size * size)
+        return counts.reshape(len(tables), size, size).astype(float)
 
     @staticmethod
     def of_participants(participants: List[Participant], sector=None):
-        mats = [
-            ConfusionMatrix.of_azimuths(participant.get_responses(sector)).normalized
-            for participant in participants
-        ]
-        return np.mean(mats)
+        # Mean of the participants' row-normalized azimuth matrices
+        accumulator = ConfusionAccumulator.of_participants(participants, sector, "azimuths")
+        return accumulator.mean_normalized
+
+
+@dataclass
+class ConfusionAccumulator:
+    # Running sums over a stream of confusion matrices: pooled totals plus the sum and sum of
+    # squares of each matrix normalized so its rows (true values) sum to unity. Memory is fixed
+    # at three k x k arrays however many matrices are added, and accumulators built over
+    # separate shards merge() into the one that adding every matrix to a single one would give.
+    labels: Optional[list] = None
+    count: int = 0
+    totals: Optional[np.ndarray] = None
+    normalized_sum: Optional[np.ndarray] = None
+    normalized_square_sum: Optional[np.ndarray] = None
+
+    def _check_labels(self, labels: list):
+        if self.labels is None:
+            size = len(labels)
+            self.labels = list(labels)
+            self.totals = np.zeros((size, size))
+            self.normalized_sum = np.zeros((size, size))
+            self.normalized_square_sum = np.zeros((size, size))
+        elif list(labels) != self.labels:
+            raise ValueError(f"Labels {list(labels)} differ from accumulated labels {self.labels}")
+
+    def add_totals(self, totals: np.ndarray, labels=None):
+        # Adds one (k x k) matrix of totals, or a (matrices x k x k) stack of them
+        totals = np.asarray(totals, dtype=float)
+        if totals.ndim == 2:
+            totals = totals[None]
+        if labels is None:
+            labels = list(range(totals.shape[-1]))
+        self._check_labels(labels)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            normalized = np.nan_to_num(totals / totals.sum(axis=-1, keepdims=True), 0)
+        self.count += len(totals)
+        self.totals += totals.sum(axis=0)
+        self.normalized_sum += normalized.sum(axis=0)
+        self.normalized_square_sum += np.einsum("nij,nij->ij", normalized, normalized)
+        return self
+
+    def add_matrix(self, matrix: ConfusionMatrix):
+        return self.add_totals(matrix.totals, matrix.labels)
+
+    def add_responses(self, responses: Union[List[Response], ResponseTable], kind="indices"):
+        # Adds the matrix of one unit's responses, usually one participant's
+        if kind == "indices":
+            return self.add_matrix(ConfusionMatrix.of_indices(responses))
+        elif kind == "azimuths":
+            return self.add_matrix(ConfusionMatrix.of_azimuths(responses))
+        raise ValueError(f"Unknown confusion matrix kind {kind}")
+
+    def add_participants(self, participants: Iterable[Participant], sector=None, kind="indices"):
+        # Builds each matrix straight from the participant's table rather than through
+        # get_confusion_matrix, so streaming a study doesn't fill every participant's cache
+        for participant in participants:
+            self.add_responses(participant.get_table(sector), kind)
+        return self
+
+    def merge(self, other: "ConfusionAccumulator"):
+        if other.labels is None:
+            return self
+        self._check_labels(other.labels)
+        self.count += other.count
+        self.totals += other.totals
+        self.normalized_sum += other.normalized_sum
+        self.normalized_square_sum += other.normalized_square_sum
+        return self
+
+    @property
+    def pooled(self):
+        self._check_not_empty()
+        return ConfusionMatrix(self.totals.copy(), self.labels)
+
+    def _check_not_empty(self):
+        if not self.count:
+            raise ValueError("No confusion matrices have been accumulated")
+
+    @property
+    def mean_normalized(self):
+        self._check_not_empty()
+        return self.normalized_sum / self.count
+
+    @property
+    def normalized_standard_error(self):
+        # Per-cell standard error of mean_normalized, from the sample variance across matrices
+        mean = self.mean_normalized
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = (self.normalized_square_sum - self.count * mean**2) / (self.count - 1)
+        return np.sqrt(np.maximum(variance, 0) / self.count)
+
+    @staticmethod
+    def of_participants(participants: Iterable[Participant], sector=None, kind="indices"):
+        return ConfusionAccumulator().add_participants(participants, sector, kind)
+
+
+def accumulate_conditions(conditions, sectors=(None,), kind="indices"):
+    # One accumulator per (condition position, sector), streaming each condition's participants
+    return {
+        (position, sector): ConfusionAccumulator.of_participants(condition.get(), sector, kind)
+        for position, condition in enumerate(conditions)
+        for sector in sectors
+    }
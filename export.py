@@ -1,41 +1,340 @@
-from csv import DictWriter
-from os import path
+from argparse import ArgumentParser
+from os import listdir, makedirs, path, remove
+import csv
+
+import numpy as np
+import pandas as pd
 
-from loader import echo_study
 from confusion import ConfusionMatrix
-from sensitivity import get_interstim_sensitivities_for_confusion_matrix
+from sensitivity import get_interstim_sensitivity_arrays
+from util import atomic_output_path, hash_file, read_json, write_json
 
 filename = "data_export.csv"
 file_path = path.normpath(path.join(__file__, "..", filename))
+formats = ("csv", "parquet", "feather")
+sectors = ("left", "center", "right")
+chunk_size = 500
+
+column_types = {
+    "participant_id": "string",
+    "slowdown": "int32",
+    "compensation": "int32",
+    "sector": "string",
+    "dist_positions": "int16",
+    "dist_degrees": "int16",
+    "d_prime": "float64",
+}
+columns = list(column_types)
+
+
+def _get_empty_frame():
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in column_types.items()})
+
+
+def _get_sector_sensitivity_arrays(participants, sector):
+    try:
+        totals = ConfusionMatrix.stack_of_participants(participants, sector, kind="azimuths")
+    except ValueError:
+        # Participants whose azimuth ranges differ can't share a tensor
+        return None
+    return get_interstim_sensitivity_arrays(totals)
+
+
+def _get_participant_sensitivity_arrays(participant, sector):
+    matrix = participant.get_confusion_matrix(sector, kind="azimuths")
+    return get_interstim_sensitivity_arrays(matrix.totals)
+
+
+def _get_chunk_frame(participants):
+    sector_arrays = [_get_sector_sensitivity_arrays(participants, sector) for sector in sectors]
+    if all(arrays is not None for arrays in sector_arrays):
+        # (participants, sectors, pairs), flattened participant-major like the original export
+        distances = np.stack([arrays[0] for arrays in sector_arrays], axis=1)
+        d_primes = np.stack([arrays[1] for arrays in sector_arrays], axis=1)
+        participant_positions, sector_positions, _ = np.indices(d_primes.shape)
+        participant_positions = participant_positions.ravel()
+        sector_positions = sector_positions.ravel()
+        distances = distances.ravel()
+        d_primes = d_primes.ravel()
+    else:
+        blocks = [
+            (participant_position, sector_position)
+            + _get_participant_sensitivity_arrays(participant, sector)
+            for participant_position, participant in enumerate(participants)
+            for sector_position, sector in enumerate(sectors)
+        ]
+        lengths = [len(block[3]) for block in blocks]
+        participant_positions = np.repeat([block[0] for block in blocks], lengths)
+        sector_positions = np.repeat([block[1] for block in blocks], lengths)
+        distances = np.concatenate([block[2] for block in blocks])
+        d_primes = np.concatenate([block[3] for block in blocks])
+    participant_ids = np.array([p.prolific_pid for p in participants], dtype=object)
+    slowdowns = np.array([p.slowdown for p in participants])
+    compensations = np.array([p.compensation for p in participants])
+    frame = pd.DataFrame(
+        {
+            "participant_id": participant_ids[participant_positions],
+            "slowdown": slowdowns[participant_positions],
+            "compensation": compensations[participant_positions],
+            "sector": np.array(sectors, dtype=object)[sector_positions],
+            "dist_positions": distances,
+            "dist_degrees": 10 * distances,
+            "d_prime": d_primes,
+        }
+    )
+    return frame.astype(column_types)
+
+
+def get_export_frames(participants, size=chunk_size):
+    for start in range(0, len(participants), size):
+        yield _get_chunk_frame(participants[start : start + size])
+
+
+def _write_csv(frames, output_path, append=False):
+    with open(output_path, "a" if append else "w", newline="") as file:
+        writer = csv.writer(file)
+        if not append:
+            writer.writerow(columns)
+        for frame in frames:
+            writer.writerows(zip(*(frame[column].tolist() for column in columns)))
+
+
+def _write_arrow(frames, output_path, output_format):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.Schema.from_pandas(_get_empty_frame(), preserve_index=False)
+    if output_format == "parquet":
+        writer = pq.ParquetWriter(output_path, schema)
+    else:
+        # Feather V2 is the Arrow IPC file format, which can be written one batch at a time
+        writer = pa.ipc.new_file(output_path, schema)
+    with writer:
+        for frame in frames:
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+
+
+def _write_frames(frames, output_path, output_format):
+    if output_format == "csv":
+        _write_csv(frames, output_path)
+    elif output_format in ("parquet", "feather"):
+        _write_arrow(frames, output_path, output_format)
+    else:
+        raise ValueError(f"Unknown export format {output_format}")
+
+
+def write_export(participants, output_path=file_path, output_format="csv", size=chunk_size):
+    _write_frames(get_export_frames(participants, size), output_path, output_format)
+    # The manifest describes the export this replaces, so the next incremental run starts over
+    manifest_path = _get_manifest_path(output_path)
+    if path.exists(manifest_path):
+        remove(manifest_path)
+
+
+def _get_part_paths(export_path):
+    return [
+        path.join(export_path, filename)
+        for filename in sorted(listdir(export_path))
+        if filename.startswith("part-")
+    ]
+
+
+def load_export_table(export_path):
+    # Feather exports are uncompressed Arrow IPC files, so the columns of the returned table are
+    # views of the memory-mapped file. Parquet pages are decoded into memory. Incremental exports
+    # are directories of part files, read as one table.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if path.isdir(export_path):
+        tables = [load_export_table(part_path) for part_path in _get_part_paths(export_path)]
+        if not tables:
+            return pa.Table.from_pandas(_get_empty_frame(), preserve_index=False)
+        return pa.concat_tables(tables)
+    if export_path.endswith(".parquet"):
+        return pq.read_table(export_path)
+    return pa.ipc.open_file(pa.memory_map(export_path, "r")).read_all()
+
+
+def load_export(export_path=file_path):
+    if export_path.endswith(".csv"):
+        return pd.read_csv(export_path, dtype=column_types, float_precision="round_trip")
+    # to_pandas copies the columns into pandas' own blocks
+    return load_export_table(export_path).to_pandas()
+
+
+def _get_manifest_path(output_path):
+    # Keyed by the full output name, as exports in different formats share a stem
+    return f"{output_path}.manifest.json"
+
+
+def _get_part_path(output_path, part, output_format):
+    return path.join(output_path, f"part-{part:05d}.{output_format}")
+
+
+def _reset_output(output_path, output_format):
+    # CSV exports are one file, while incremental columnar exports are a directory with a part
+    # file per update, replacing any single-file export at the same path
+    if output_format == "csv":
+        return
+    if path.isfile(output_path):
+        remove(output_path)
+    makedirs(output_path, exist_ok=True)
+    for part_path in _get_part_paths(output_path):
+        remove(part_path)
+
+
+def _drop_from_csv(output_path, dropped_pids):
+    existing = load_export(output_path)
+    existing = existing[~existing["participant_id"].isin(dropped_pids)]
+    with atomic_output_path(output_path) as temp_path:
+        _write_csv([existing], temp_path)
+
+
+def _drop_from_parts(output_path, output_format, parts, dropped_pids):
+    # Rewrites only the parts that held rows of dropped participants
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    dropped = pa.array(sorted(dropped_pids), type=pa.string())
+    for part in sorted(parts):
+        part_path = _get_part_path(output_path, part, output_format)
+        table = load_export_table(part_path)
+        kept = table.filter(pc.invert(pc.is_in(table["participant_id"], value_set=dropped)))
+        if len(kept) == len(table):
+            continue
+        if len(kept) == 0:
+            remove(part_path)
+            continue
+        with atomic_output_path(part_path, f".tmp.{output_format}") as temp_path:
+            _write_frames([kept.to_pandas()], temp_path, output_format)
+
+
+def update_export(
+    output_path=file_path,
+    output_format="csv",
+    data_file_paths=None,
+    size=chunk_size,
+):
+    # Brings an existing export up to date by computing rows only for data files whose content
+    # hash isn't in the manifest, and dropping rows for participants that are gone or now rejected.
+    # New rows are appended to a CSV export or written as a new part of a columnar one, and only
+    # the CSV or the parts holding dropped participants are rewritten.
+    import loader
+    from models import ParticipantException
+    from study import create_query
+
+    if data_file_paths is None:
+        data_file_paths = loader.get_data_file_paths()
+    manifest_path = _get_manifest_path(output_path)
+    manifest = read_json(manifest_path)
+    if manifest is None or manifest["format"] != output_format or not path.exists(output_path):
+        manifest = {"format": output_format, "invalid_prolific_pids": [], "files": {}}
+        _reset_output(output_path, output_format)
+    previous_entries = manifest["files"]
+    invalid_pids_changed = manifest["invalid_prolific_pids"] != loader.invalid_prolific_pids
+    entries = {}
+    digests = {}
+    for data_file_path in data_file_paths:
+        key = path.basename(data_file_path)
+        entry = previous_entries.get(key)
+        signature = list(loader.get_file_signature(data_file_path))
+        if entry and entry["signature"] == signature:
+            digest = entry["hash"]
+        else:
+            digest = hash_file(data_file_path)
+        if not entry or entry["hash"] != digest or (invalid_pids_changed and not entry["exported"]):
+            digests[data_file_path] = digest
+            continue
+        exported = entry["exported"] and entry["participant_id"] not in loader.invalid_prolific_pids
+        entries[key] = {**entry, "signature": signature, "exported": exported}
+
+    retained_pids = {entry["participant_id"] for entry in entries.values() if entry["exported"]}
+    dropped_entries = [
+        entry
+        for entry in previous_entries.values()
+        if entry["exported"] and entry["participant_id"] not in retained_pids
+    ]
+    dropped_pids = {entry["participant_id"] for entry in dropped_entries}
+
+    # New files are parsed without the study's parse cache, which would otherwise be read and
+    # rewritten in full for every update
+    _, test = create_query()
+    new_participants = []
+    new_part = manifest.get("next_part", 0)
+    parsed = loader.load_participants_by_file(list(digests), use_cache=False)
+    for data_file_path, result in parsed.items():
+        exported = not isinstance(result, ParticipantException) and test(result)
+        entry = {
+            "hash": digests[data_file_path],
+            "signature": list(loader.get_file_signature(data_file_path)),
+            "participant_id": result.prolific_pid,
+            "exported": exported,
+        }
+        if exported:
+            new_participants.append(result)
+            if output_format != "csv":
+                entry["part"] = new_part
+        entries[path.basename(data_file_path)] = entry
+
+    new_frames = get_export_frames(new_participants, size)
+    if output_format == "csv":
+        if dropped_pids:
+            _drop_from_csv(output_path, dropped_pids)
+        if not previous_entries:
+            _write_csv(new_frames, output_path)
+        elif new_participants:
+            _write_csv(new_frames, output_path, append=True)
+    else:
+        if dropped_pids:
+            parts = {entry["part"] for entry in dropped_entries}
+            _drop_from_parts(output_path, output_format, parts, dropped_pids)
+        if new_participants:
+            part_path = _get_part_path(output_path, new_part, output_format)
+            with atomic_output_path(part_path, f".tmp.{output_format}") as temp_path:
+                _write_frames(new_frames, temp_path, output_format)
+            new_part += 1
+    manifest = {
+        "format": output_format,
+        "invalid_prolific_pids": list(loader.invalid_prolific_pids),
+        "files": entries,
+    }
+    if output_format != "csv":
+        manifest["next_part"] = new_part
+    write_json(manifest_path, manifest)
+    return new_participants, dropped_pids
+
+
+def get_default_output_path(output_format):
+    if output_format == "csv":
+        return file_path
+    return f"{path.splitext(file_path)[0]}.{output_format}"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Export per-participant d' values")
+    parser.add_argument("--format", choices=formats, default="csv")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--chunk-size", type=int, default=chunk_size)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only compute rows for data files that changed since the last export",
+    )
+    args = parser.parse_args()
+    output_path = args.output or get_default_output_path(args.format)
+
+    if args.incremental:
+        new_participants, dropped_pids = update_export(
+            output_path, args.format, size=args.chunk_size
+        )
+        print(f"Added {len(new_participants)} participants, dropped {len(dropped_pids)}")
+    else:
+        from loader import echo_study
 
-columns = [
-    "participant_id",
-    "slowdown",
-    "compensation",
-    "sector",
-    "dist_positions",
-    "dist_degrees",
-    "d_prime",
-]
-
-
-with open(file_path, "w") as file:
-    writer = DictWriter(file, columns)
-    writer.writeheader()
-    for participant in echo_study.query_participants().get():
-        for sector in ("left", "center", "right"):
-            responses = participant.get_responses(sector=sector)
-            matrix = ConfusionMatrix.of_azimuths(responses)
-            sensitivities = get_interstim_sensitivities_for_confusion_matrix(matrix)
-            for (dist, d_prime) in sensitivities:
-                writer.writerow(
-                    {
-                        "participant_id": participant.prolific_pid,
-                        "slowdown": participant.slowdown,
-                        "compensation": participant.compensation,
-                        "sector": sector,
-                        "dist_positions": dist,
-                        "dist_degrees": 10 * dist,
-                        "d_prime": d_prime,
-                    }
-                )
+        write_export(
+            echo_study.query_participants().get(),
+            output_path=output_path,
+            output_format=args.format,
+            size=args.chunk_size,
+        )
@@ -0,0 +1,45 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+
+def _fit_least_squares(columns: List[np.ndarray], y: np.ndarray):
+    # Ordinary least squares for every fit along the leading axes at once. `columns` are the
+    # (..., n) design columns and NaN entries in y (or any column) mark padding to ignore.
+    design = np.stack(columns, axis=-1)
+    present = ~np.isnan(y) & ~np.isnan(design).any(axis=-1)
+    design = np.where(present[..., None], design, 0)
+    y = np.where(present, y, 0)
+    gram = np.einsum("...ni,...nj->...ij", design, design)
+    moments = np.einsum("...ni,...n->...i", design, y)
+    params = np.linalg.solve(gram, moments[..., None])[..., 0]
+    residuals = np.where(present, y - np.einsum("...ni,...i->...n", design, params), 0)
+    # Residual variance scales the covariance as curve_fit does with absolute_sigma=False
+    dof = present.sum(axis=-1) - design.shape[-1]
+    variance = np.einsum("...n,...n->...", residuals, residuals) / dof
+    covariance = np.linalg.inv(gram) * variance[..., None, None]
+    standard_errors = np.sqrt(np.diagonal(covariance, axis1=-2, axis2=-1))
+    return params, standard_errors
+
+
+def fit_log(x: np.ndarray, y: np.ndarray):
+    # Fits y = a + b * log(x), returning (..., 2) arrays of (a, b) and their standard errors
+    x = np.asarray(x, dtype=float)
+    return _fit_least_squares([np.ones_like(x), np.log(x)], np.asarray(y, dtype=float))
+
+
+def fit_lin(x: np.ndarray, y: np.ndarray):
+    # Fits y = b + m * x, returning (..., 2) arrays of (m, b) and their standard errors
+    x = np.asarray(x, dtype=float)
+    return _fit_least_squares([x, np.ones_like(x)], np.asarray(y, dtype=float))
+
+
+def get_padded_arrays(samples: Sequence[Sequence[Tuple[float, float]]]):
+    # Stacks lists of (x, y) pairs of differing lengths into NaN-padded (samples, n) arrays
+    length = max(len(sample) for sample in samples)
+    x = np.full((len(samples), length), np.nan)
+    y = np.full((len(samples), length), np.nan)
+    for position, sample in enumerate(samples):
+        if sample:
+            x[position, : len(sample)], y[position, : len(sample)] = zip(*sample)
+    return x, y
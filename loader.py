@@ -1,8 +1,16 @@
-from os import listdir, path
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count, listdir, path, stat
 from csv import DictReader
+from io import BytesIO
+import pickle
 
-from models import Response, Block, Participant, ParticipantException
+import numpy as np
+
+from models import ResponseTable, Participant, ParticipantException
+from profiling import timed
+from screening import default_rules
 from study import Study
+from util import atomic_open
 
 invalid_prolific_pids = [
     "5feb726715b59bbd3c904409",  # Wrote in to say semicolon was broken
@@ -14,6 +22,29 @@ invalid_prolific_pids = [
     # "5bc2e0ec4f3bfd00012e97b5",
 ]
 
+cache_path = path.normpath(path.join(__file__, "..", ".study_cache.pickle"))
+cache_version = 2
+
+# The columns get_participant_for_file reads; the columnar reader parses only these
+participant_file_columns = [
+    "prolificPid",
+    "version",
+    "trial_type",
+    "chosenKeyset",
+    "compensation",
+    "choices",
+    "slowdown",
+    "compensationDescriptor",
+    "azimuth",
+    "userAgent",
+    "modelName",
+    "responseAzimuth",
+    "responseDelay",
+    "filename",
+]
+file_boundary_marker = "__participant_file_boundary__"
+files_per_batch = 1000
+
 
 def get_file_paths(parent_dir):
     children = [path.join(parent_dir, child) for child in listdir(parent_dir)]
@@ -32,9 +63,11 @@ def get_participant_metadata_file_paths():
     return get_file_paths(metadata_dir)
 
 
-def load_participant_metadata():
+def load_participant_metadata(metadata_file_paths=None):
+    if metadata_file_paths is None:
+        metadata_file_paths = get_participant_metadata_file_paths()
     metadata_by_pid = {}
-    for path in get_participant_metadata_file_paths():
+    for path in metadata_file_paths:
         with open(path, "r") as file:
             reader = DictReader(file)
             for row in reader:
@@ -45,10 +78,26 @@ def load_participant_metadata():
     return metadata_by_pid
 
 
+def _get_choice_index(choices, azimuth):
+    return choices.index(azimuth) if azimuth in choices else -1
+
+
+@timed("loader.parse_file")
 def get_participant_for_file(path, metadata_by_pid):
     with open(path, "r") as data_file:
         reader = DictReader(data_file)
-        blocks = []
+        columns = {
+            "block_index": [],
+            "center_azimuth": [],
+            "true_azimuth": [],
+            "response_azimuth": [],
+            "true_index": [],
+            "response_index": [],
+            "response_delay_ms": [],
+            "azimuth_choices": [],
+            "filename": [],
+        }
+        num_blocks = 0
         prolific_pid = None
         slowdown = None
         keyset = None
@@ -68,10 +117,12 @@ def get_participant_for_file(path, metadata_by_pid):
             if row["trial_type"] == "keyset-select":
                 keyset = row.get("chosenKeyset")
             if row["trial_type"] == "block-bookend" and len(current_block_responses) == 20:
-                next_block = Block(
-                    center_azimuth=current_block_center, responses=current_block_responses
-                )
-                blocks.append(next_block)
+                for response in current_block_responses:
+                    for key, value in response.items():
+                        columns[key].append(value)
+                    columns["block_index"].append(num_blocks)
+                    columns["center_azimuth"].append(current_block_center)
+                num_blocks += 1
                 current_block_responses = []
             if row["trial_type"] == "echo-presentation":
                 compensation_str = row.get("compensation")
@@ -91,30 +142,35 @@ def get_participant_for_file(path, metadata_by_pid):
                 response_delay = row.get("responseDelay")
                 filename = row.get("filename")
                 if true_azimuth and response_azimuth:
-                    response = Response(
-                        true_azimuth=int(true_azimuth),
-                        response_azimuth=int(response_azimuth),
-                        azimuth_choices=choices,
-                        response_delay_ms=int(response_delay),
-                        filename=filename,
-                    )
+                    response = {
+                        "true_azimuth": int(true_azimuth),
+                        "response_azimuth": int(response_azimuth),
+                        "true_index": _get_choice_index(choices, int(true_azimuth)),
+                        "response_index": _get_choice_index(choices, int(response_azimuth)),
+                        "azimuth_choices": choices,
+                        "response_delay_ms": int(response_delay),
+                        "filename": filename,
+                    }
                     current_block_responses.append(response)
         metadata = metadata_by_pid.get(prolific_pid)
         if (
-            len(blocks) == 6
+            num_blocks == 6
             and slowdown
             and compensation is not None
             and compensation_descriptor
             and version
             and prolific_pid
         ):
+            if len(set(map(len, columns["azimuth_choices"]))) > 1:
+                # The response table holds choices as one (responses x choices) array
+                raise ParticipantException(prolific_pid, "ragged-choices")
             return Participant(
                 version=version,
                 user_agent=user_agent,
                 compensation=compensation,
                 compensation_descriptor=compensation_descriptor,
                 slowdown=slowdown,
-                blocks=blocks,
+                table=ResponseTable.build(**columns),
                 keyset=keyset,
                 prolific_pid=prolific_pid,
                 model_name=model_name,
@@ -124,15 +180,476 @@ def get_participant_for_file(path, metadata_by_pid):
     raise ParticipantException(prolific_pid, "missing-data")
 
 
-_participants = []
-_exceptions = []
-_metadata = load_participant_metadata()
-for file in get_data_file_paths():
+def _get_column_values(column, rows):
+    # A dictionary-encoded column is (codes, distinct values), and None stands for a column the
+    # file doesn't have, whose fields DictReader gives as None
+    if column is None:
+        return np.full(len(rows), None, dtype=object)
+    codes, values = column
+    return values[codes[rows]]
+
+
+def _get_column_value(column, row):
+    return None if column is None else column[1][column[0][row]]
+
+
+def _get_column_mask(column, rows, test):
+    # test() applied once per distinct value, then looked up for each of `rows`
+    if column is None:
+        return np.full(len(rows), bool(test(None)))
+    codes, values = column
+    return np.array([bool(test(value)) for value in values], dtype=bool)[codes[rows]]
+
+
+def _get_column_ints(column, rows, nan_value=None):
+    # int() of every value in `rows`, as the row-by-row parser converts each field, but called
+    # once per distinct value. It raises for values int() rejects, as that parser does.
+    if column is None:
+        return np.array([int(None) for _ in rows], dtype=np.int64)
+    codes, values = column
+    used = np.unique(codes[rows])
+    lookup = np.zeros(len(values), dtype=np.int64)
+    lookup[used] = [
+        nan_value if nan_value is not None and value == "NaN" else int(value)
+        for value in values[used]
+    ]
+    return lookup[codes[rows]]
+
+
+def _get_file_positions(rows, file_ids, num_files):
+    # Positions in `rows` (ascending) of the first and the last row of each file, or -1 for
+    # files without any
+    files = file_ids[rows]
+    file_range = np.arange(num_files)
+    firsts = np.searchsorted(files, file_range, side="left")
+    lasts = np.searchsorted(files, file_range, side="right") - 1
+    has_rows = lasts >= firsts
+    return np.where(has_rows, firsts, -1), np.where(has_rows, lasts, -1)
+
+
+def _parse_choices(value):
     try:
-        participant = get_participant_for_file(file, _metadata)
-        _participants.append(participant)
+        return tuple(map(int, value.split(",")))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _get_block_bounds(bookend_rows, bookend_counts, start_counts, file_ids):
+    # Blocks close on a bookend once exactly 20 responses have built up since the last block
+    # closed. Where every bookend of a file follows either 0 or 20 new responses, which is every
+    # well-formed file, the last close is always the previous bookend and the blocks are found
+    # at once. Other files replay the rule bookend by bookend.
+    bookend_files = file_ids[bookend_rows]
+    previous_counts = start_counts[bookend_files]
+    follows = np.flatnonzero(bookend_files[1:] == bookend_files[:-1]) + 1
+    previous_counts[follows] = bookend_counts[follows - 1]
+    new_responses = bookend_counts - previous_counts
+    irregular = ~np.isin(new_responses, (0, 20))
+    irregular_files = np.unique(bookend_files[irregular])
+    regular = (new_responses == 20) & ~np.isin(bookend_files, irregular_files)
+    rows = [bookend_rows[regular]]
+    starts = [previous_counts[regular]]
+    stops = [bookend_counts[regular]]
+    for file_id in irregular_files.tolist():
+        positions = np.flatnonzero(bookend_files == file_id)
+        flushed = start_counts[file_id]
+        for position in positions.tolist():
+            if bookend_counts[position] - flushed == 20:
+                rows.append([bookend_rows[position]])
+                starts.append([flushed])
+                stops.append([bookend_counts[position]])
+                flushed = bookend_counts[position]
+    rows, starts, stops = (np.concatenate(values).astype(int) for values in (rows, starts, stops))
+    order = np.argsort(rows, kind="stable")
+    return rows[order], starts[order], stops[order]
+
+
+def _get_participants_for_columns(columns, file_ids, fallback, metadata_by_pid):
+    # Mirrors get_participant_for_file for a batch of files at once. `columns` holds the
+    # dictionary-encoded columns over every file's rows, in file order, and file_ids the file
+    # each row came from. Returns a Participant or ParticipantException per file, or None for
+    # files only the row-by-row parser can reproduce, including those marked in fallback.
+    num_files = len(fallback)
+    fallback = fallback.copy()
+    results = [None] * num_files
+    num_rows = len(file_ids)
+    all_rows = np.arange(num_rows)
+    file_starts = np.searchsorted(file_ids, np.arange(num_files))
+    file_stops = np.append(file_starts[1:], num_rows)
+
+    # Files raise at their first row with an invalid PID, or any row if there's no version
+    invalid = _get_column_mask(columns["prolificPid"], all_rows, invalid_prolific_pids.__contains__)
+    stopped = invalid if columns["version"] is not None else np.ones(num_rows, dtype=bool)
+    stop_rows = np.flatnonzero(stopped)
+    first_stops, _ = _get_file_positions(stop_rows, file_ids, num_files)
+    for file_id in np.flatnonzero((first_stops >= 0) & ~fallback).tolist():
+        stop = stop_rows[first_stops[file_id]]
+        if columns["trial_type"] is None and stop != file_starts[file_id]:
+            raise KeyError("trial_type")
+        reason = "marked-invalid" if invalid[stop] else "no-version"
+        results[file_id] = ParticipantException(
+            _get_column_value(columns["prolificPid"], stop), reason
+        )
+    active_files = (first_stops < 0) & ~fallback
+    if columns["trial_type"] is None:
+        if np.any(active_files & (file_stops > file_starts)):
+            raise KeyError("trial_type")
+        trial_types = np.full(num_rows, None, dtype=object)
+    else:
+        trial_types = _get_column_values(columns["trial_type"], all_rows)
+
+    # Choices must parse to the same number of azimuths in every row for the (rows x choices)
+    # array, so files with others are left to the row-by-row parser
+    echo_rows = np.flatnonzero(active_files[file_ids] & (trial_types == "echo-presentation"))
+    choice_column = columns["choices"] or (np.zeros(num_rows, dtype=int), np.array([None]))
+    parsed_choices = [_parse_choices(value) for value in choice_column[1]]
+    choice_lengths = np.array([len(c) if c else -1 for c in parsed_choices])
+    echo_lengths = choice_lengths[choice_column[0][echo_rows]]
+    valid_lengths = echo_lengths[echo_lengths >= 3]
+    width = int(np.bincount(valid_lengths).argmax()) if len(valid_lengths) else 3
+    fallback[file_ids[echo_rows[echo_lengths != width]]] = True
+    active_files &= ~fallback
+    active = active_files[file_ids]
+    echo_rows = echo_rows[active[echo_rows]]
+    choice_matrix = np.zeros((len(parsed_choices), width), dtype=np.int64)
+    for position, choices in enumerate(parsed_choices):
+        if choices and len(choices) == width:
+            choice_matrix[position] = choices
+    echo_choices = choice_matrix[choice_column[0][echo_rows]]
+
+    keyset_rows = np.flatnonzero(active & (trial_types == "keyset-select"))
+    _, last_keysets = _get_file_positions(keyset_rows, file_ids, num_files)
+    _, last_echoes = _get_file_positions(echo_rows, file_ids, num_files)
+    slowdowns = _get_column_ints(columns["slowdown"], echo_rows)
+    compensations = _get_column_ints(columns["compensation"], echo_rows, nan_value=0)
+
+    is_response = _get_column_mask(columns["azimuth"], echo_rows, bool)
+    is_response &= _get_column_mask(columns["responseAzimuth"], echo_rows, bool)
+    response_rows = echo_rows[is_response]
+    response_echoes = np.flatnonzero(is_response)
+    true_azimuths = _get_column_ints(columns["azimuth"], response_rows)
+    response_azimuths = _get_column_ints(columns["responseAzimuth"], response_rows)
+    response_delays = _get_column_ints(columns["responseDelay"], response_rows)
+
+    bookend_rows = np.flatnonzero(active & (trial_types == "block-bookend"))
+    block_rows, block_starts, block_stops = _get_block_bounds(
+        bookend_rows,
+        np.searchsorted(response_rows, bookend_rows),
+        np.searchsorted(response_rows, file_starts),
+        file_ids,
+    )
+    block_files = file_ids[block_rows]
+    # A block's center is the middle choice of the last echo row before its closing bookend
+    block_centers = echo_choices[np.searchsorted(echo_rows, block_rows) - 1, 2]
+    num_blocks = np.bincount(block_files, minlength=num_files)
+    lengths = block_stops - block_starts
+    offsets = np.cumsum(lengths) - lengths
+    kept = np.repeat(block_starts - offsets, lengths) + np.arange(lengths.sum())
+    kept_rows = response_rows[kept]
+    choices = echo_choices[response_echoes[kept]]
+    true_azimuth = true_azimuths[kept]
+    response_azimuth = response_azimuths[kept]
+    block_indices = np.arange(len(block_rows)) - np.searchsorted(block_files, block_files)
+    table = ResponseTable.build(
+        block_index=np.repeat(block_indices, lengths),
+        center_azimuth=np.repeat(block_centers, lengths),
+        true_azimuth=true_azimuth,
+        response_azimuth=response_azimuth,
+        true_index=_get_choice_indices(choices, true_azimuth),
+        response_index=_get_choice_indices(choices, response_azimuth),
+        response_delay_ms=response_delays[kept],
+        azimuth_choices=choices,
+        filename=_get_column_values(columns["filename"], kept_rows),
+    )
+    file_lengths = np.bincount(block_files, weights=lengths, minlength=num_files).astype(int)
+    table_stops = np.cumsum(file_lengths)
+    table_starts = table_stops - file_lengths
+
+    for file_id in np.flatnonzero(active_files).tolist():
+        prolific_pid = None
+        if file_stops[file_id] > file_starts[file_id]:
+            prolific_pid = _get_column_value(columns["prolificPid"], file_stops[file_id] - 1)
+        last_echo = last_echoes[file_id]
+        if last_echo < 0:
+            results[file_id] = ParticipantException(prolific_pid, "missing-data")
+            continue
+        echo_row = echo_rows[last_echo]
+        slowdown = int(slowdowns[last_echo])
+        compensation_descriptor = _get_column_value(columns["compensationDescriptor"], echo_row)
+        version = _get_column_value(columns["version"], echo_row)
+        if not (
+            num_blocks[file_id] == 6
+            and slowdown
+            and compensation_descriptor
+            and version
+            and prolific_pid
+        ):
+            results[file_id] = ParticipantException(prolific_pid, "missing-data")
+            continue
+        last_keyset = last_keysets[file_id]
+        metadata = metadata_by_pid.get(prolific_pid)
+        results[file_id] = Participant(
+            version=version,
+            user_agent=_get_column_value(columns["userAgent"], echo_row),
+            compensation=int(compensations[last_echo]),
+            compensation_descriptor=compensation_descriptor,
+            slowdown=slowdown,
+            table=table[int(table_starts[file_id]) : int(table_stops[file_id])],
+            keyset=(
+                _get_column_value(columns["chosenKeyset"], keyset_rows[last_keyset])
+                if last_keyset >= 0
+                else None
+            ),
+            prolific_pid=prolific_pid,
+            model_name=_get_column_value(columns["modelName"], echo_row),
+            sex=metadata["sex"],
+            age=(int(metadata["age"]) if metadata["age"] else None),
+        )
+    return results
+
+
+def _get_choice_indices(choices: np.ndarray, azimuths: np.ndarray):
+    matches = choices == azimuths[:, None]
+    return np.where(matches.any(axis=1), matches.argmax(axis=1), -1)
+
+
+def _read_file_columns(files, header):
+    # Parses files that share a header in one pass of pyarrow's CSV reader, with a marker row
+    # between files. Returns each read column dictionary-encoded as (codes, distinct values),
+    # the file of each row, and which files had rows DictReader tolerates but pyarrow doesn't
+    # (short or long ones), for the row-by-row parser.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pv
+
+    names = pv.read_csv(BytesIO(header + b"\n")).column_names
+    if len(set(names)) != len(names):
+        raise pa.ArrowInvalid("Duplicate column names")
+    included = list(dict.fromkeys([names[0], *(c for c in participant_file_columns if c in names)]))
+    marker = f"{file_boundary_marker}{',' * (len(names) - 1)}\n".encode()
+    skipped_records = []
+
+    def skip_row(row):
+        skipped_records.append(row.number)
+        return "skip"
+
+    table = pv.read_csv(
+        BytesIO(header + b"\n" + b"".join(marker + body for _, body in files)),
+        read_options=pv.ReadOptions(use_threads=False),
+        parse_options=pv.ParseOptions(newlines_in_values=True, invalid_row_handler=skip_row),
+        convert_options=pv.ConvertOptions(
+            column_types={column: pa.string() for column in included},
+            include_columns=included,
+            strings_can_be_null=False,
+            quoted_strings_can_be_null=False,
+        ),
+    )
+    if None in skipped_records:
+        raise pa.ArrowInvalid("Skipped rows without record numbers")
+
+    encoded = {}
+    for column in included:
+        array = pc.dictionary_encode(table.column(column).combine_chunks())
+        encoded[column] = (
+            array.indices.to_numpy(zero_copy_only=False),
+            array.dictionary.to_numpy(zero_copy_only=False),
+        )
+    first_codes, first_values = encoded[names[0]]
+    is_marker = (first_values == file_boundary_marker)[first_codes]
+    kept = ~is_marker
+    file_ids = np.cumsum(is_marker)[kept] - 1
+    columns = {
+        column: (encoded[column][0][kept], encoded[column][1]) if column in encoded else None
+        for column in participant_file_columns
+    }
+
+    # Records number from 1 for the header, and skipped ones fall between the rows read
+    fallback = np.zeros(len(files), dtype=bool)
+    if skipped_records:
+        skipped = np.array(skipped_records) - 2
+        records = np.ones(len(table) + len(skipped), dtype=bool)
+        records[skipped] = False
+        marker_records = np.flatnonzero(records)[is_marker]
+        fallback[np.searchsorted(marker_records, skipped) - 1] = True
+    return columns, file_ids, fallback
+
+
+def _read_files_by_header(file_paths):
+    files_by_header = {}
+    for file_path in file_paths:
+        with open(file_path, "rb") as file:
+            header, _, body = file.read().partition(b"\n")
+        if body and not body.endswith(b"\n"):
+            body += b"\n"
+        files_by_header.setdefault(header, []).append((file_path, body))
+    return files_by_header
+
+
+@timed("loader.parse_files")
+def get_participants_for_files(file_paths, metadata_by_pid):
+    # Columnar counterpart to get_participant_for_file for many files at once. Returns a
+    # Participant or ParticipantException per file, in file order.
+    import pyarrow as pa
+
+    results = {}
+    for start in range(0, len(file_paths), files_per_batch):
+        files_by_header = _read_files_by_header(file_paths[start : start + files_per_batch])
+        for header, files in files_by_header.items():
+            parsed = [None] * len(files)
+            if header.strip():
+                try:
+                    columns, file_ids, fallback = _read_file_columns(files, header)
+                except (pa.ArrowInvalid, UnicodeDecodeError):
+                    # Encodings or headers only DictReader makes sense of
+                    pass
+                else:
+                    parsed = _get_participants_for_columns(
+                        columns, file_ids, fallback, metadata_by_pid
+                    )
+            for (file_path, _), result in zip(files, parsed):
+                results[file_path] = (
+                    _parse_file(file_path, metadata_by_pid) if result is None else result
+                )
+    return [results[file_path] for file_path in file_paths]
+
+
+_worker_metadata_by_pid = None
+
+
+def _init_worker(metadata_by_pid):
+    # Each worker receives the parsed metadata once, rather than with every chunk of files
+    global _worker_metadata_by_pid
+    _worker_metadata_by_pid = metadata_by_pid
+
+
+def _parse_files_in_worker(file_paths):
+    return get_participants_for_files(file_paths, _worker_metadata_by_pid)
+
+
+def _parse_files(file_paths, metadata_by_pid, workers=1):
+    num_workers = workers or cpu_count() or 1
+    if num_workers == 1 or len(file_paths) < 2:
+        return get_participants_for_files(file_paths, metadata_by_pid)
+    # Contiguous chunks, a few per worker to even out the load; map() keeps them in file order
+    chunk_size = min(files_per_batch, -(-len(file_paths) // (4 * num_workers)))
+    chunks = [file_paths[i : i + chunk_size] for i in range(0, len(file_paths), chunk_size)]
+    with ProcessPoolExecutor(
+        max_workers=num_workers, initializer=_init_worker, initargs=(metadata_by_pid,)
+    ) as executor:
+        return [
+            result for results in executor.map(_parse_files_in_worker, chunks) for result in results
+        ]
+
+
+def get_file_signature(file_path):
+    file_stat = stat(file_path)
+    return (file_stat.st_mtime_ns, file_stat.st_size)
+
+
+def _get_cache_context():
+    # Parsed participants also depend on the metadata files and the invalid PID list
+    metadata_signatures = sorted(
+        (file_path, get_file_signature(file_path))
+        for file_path in get_participant_metadata_file_paths()
+    )
+    return (cache_version, tuple(metadata_signatures), tuple(invalid_prolific_pids))
+
+
+def _read_cache(cache_file_path, context):
+    try:
+        with open(cache_file_path, "rb") as file:
+            cache = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return {}
+    if cache.get("context") != context:
+        return {}
+    return cache["entries"]
+
+
+def _write_cache(cache_file_path, context, entries):
+    with atomic_open(cache_file_path, "wb") as file:
+        pickle.dump({"context": context, "entries": entries}, file, pickle.HIGHEST_PROTOCOL)
+
+
+def _parse_file(file_path, metadata_by_pid):
+    try:
+        return get_participant_for_file(file_path, metadata_by_pid)
     except ParticipantException as ex:
-        _exceptions.append(ex)
+        return ex
+
+
+def load_participants_by_file(
+    data_file_paths, use_cache=True, cache_file_path=cache_path, workers=1
+):
+    context = _get_cache_context()
+    cached_entries = _read_cache(cache_file_path, context) if use_cache else {}
+    entries = {}
+    signatures = {}
+    for file_path in data_file_paths:
+        signature = get_file_signature(file_path)
+        cached = cached_entries.get(file_path)
+        if cached and cached[0] == signature:
+            entries[file_path] = cached
+        else:
+            signatures[file_path] = signature
+    changed = bool(signatures)
+    if changed:
+        uncached_paths = list(signatures)
+        results = _parse_files(uncached_paths, load_participant_metadata(), workers)
+        parsed = dict(zip(uncached_paths, results))
+        entries = {
+            file_path: entries.get(file_path) or (signatures[file_path], parsed[file_path])
+            for file_path in data_file_paths
+        }
+    if use_cache:
+        # Keep entries for other files that still exist, so loading a subset doesn't evict them
+        retained = {
+            file_path: entry
+            for file_path, entry in cached_entries.items()
+            if file_path not in entries and path.isfile(file_path)
+        }
+        removed = any(p not in entries and p not in retained for p in cached_entries)
+        if changed or removed:
+            _write_cache(cache_file_path, context, {**retained, **entries})
+    return {file_path: result for file_path, (_, result) in entries.items()}
+
+
+@timed("loader.load_study")
+def load_study(
+    data_file_paths=None,
+    use_cache=True,
+    cache_file_path=cache_path,
+    verbose=True,
+    workers=1,
+    screening_rules=default_rules,
+    exclude_flagged=False,
+):
+    # Only files missing from the cache are parsed, across `workers` processes (None for one per
+    # core). Results are gathered in file order either way. Participants are then screened with
+    # `screening_rules`, and rejected if they fail any when `exclude_flagged` is set.
+    if data_file_paths is None:
+        data_file_paths = get_data_file_paths()
+    results = load_participants_by_file(data_file_paths, use_cache, cache_file_path, workers)
+    participants = []
+    exceptions = []
+    for file_path in data_file_paths:
+        result = results[file_path]
+        if isinstance(result, ParticipantException):
+            exceptions.append(result)
+        else:
+            participants.append(result)
+    study = Study(participants, exceptions)
+    study.screen(screening_rules)
+    if exclude_flagged:
+        study = study.without_flagged()
+    if verbose:
+        study.print_summary()
+    return study
+
 
-echo_study = Study(_participants, _exceptions)
-echo_study.print_summary()
+def __getattr__(name):
+    # Defer loading until `echo_study` is first accessed so that `import loader` stays cheap
+    if name == "echo_study":
+        globals()["echo_study"] = load_study()
+        return globals()["echo_study"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,17 +1,37 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
 from functools import cached_property
 
-from util import merge_distributions, flag_block
+import numpy as np
 
+from util import merge_distributions, flag_block, BoundedCache
 
-@dataclass
+
+@dataclass(frozen=True)
 class Response:
+    # Indices into azimuth_choices are computed once when loading (-1 if absent), and
+    # azimuth_choices is a tuple shared by every response with the same choices
+    __slots__ = (
+        "true_azimuth",
+        "response_azimuth",
+        "filename",
+        "azimuth_choices",
+        "response_delay_ms",
+        "true_index",
+        "response_index",
+    )
     true_azimuth: int
     response_azimuth: int
     filename: str
-    azimuth_choices: List[int]
+    azimuth_choices: Tuple[int, ...]
     response_delay_ms: int
+    true_index: int
+    response_index: int
+
+    def __reduce__(self):
+        # Frozen slotted instances can't have their state set after creation, so pickle and copy
+        # rebuild them through __init__
+        return (Response, tuple(getattr(self, name) for name in self.__slots__))
 
     @property
     def is_correct(self):
@@ -21,23 +41,136 @@ class Response:
     def error(self):
         return self.response_azimuth - self.true_azimuth
 
+
+@dataclass(eq=False)
+class ResponseTable:
+    participant_index: np.ndarray
+    block_index: np.ndarray
+    center_azimuth: np.ndarray
+    true_azimuth: np.ndarray
+    response_azimuth: np.ndarray
+    true_index: np.ndarray
+    response_index: np.ndarray
+    response_delay_ms: np.ndarray
+    azimuth_choices: np.ndarray
+    filename: np.ndarray
+
+    dtypes = {
+        "participant_index": np.int32,
+        "block_index": np.int16,
+        "center_azimuth": np.int16,
+        "true_azimuth": np.int16,
+        "response_azimuth": np.int16,
+        "true_index": np.int8,
+        "response_index": np.int8,
+        "response_delay_ms": np.int32,
+        "azimuth_choices": np.int16,
+        "filename": object,
+    }
+
+    @staticmethod
+    def build(**columns):
+        num_rows = len(columns["true_azimuth"])
+        arrays = {}
+        for name, dtype in ResponseTable.dtypes.items():
+            values = columns.get(name)
+            if values is None:
+                arrays[name] = np.zeros(num_rows, dtype=dtype)
+            elif dtype is object:
+                arrays[name] = np.empty(num_rows, dtype=object)
+                arrays[name][:] = values
+            else:
+                arrays[name] = np.asarray(values, dtype=dtype)
+        if num_rows == 0:
+            arrays["azimuth_choices"] = arrays["azimuth_choices"].reshape(0, 0)
+        return ResponseTable(**arrays)
+
+    @staticmethod
+    def concatenate(tables: List["ResponseTable"]):
+        if not tables:
+            return ResponseTable.build(true_azimuth=[])
+        return ResponseTable(
+            **{
+                name: np.concatenate([getattr(table, name) for table in tables])
+                for name in ResponseTable.dtypes
+            }
+        )
+
+    def __len__(self):
+        return len(self.true_azimuth)
+
+    def __getitem__(self, key):
+        return ResponseTable(**{name: getattr(self, name)[key] for name in ResponseTable.dtypes})
+
+    def sector_mask(self, sector=None):
+        if sector == "left":
+            return self.center_azimuth < 0
+        elif sector == "right":
+            return self.center_azimuth > 0
+        elif sector == "center":
+            return self.center_azimuth == 0
+        return None
+
+    def select(self, sector=None):
+        mask = self.sector_mask(sector)
+        return self if mask is None else self[mask]
+
     @property
-    def true_index(self):
-        return self.azimuth_choices.index(self.true_azimuth)
+    def is_correct(self):
+        return self.response_azimuth == self.true_azimuth
 
     @property
-    def response_index(self):
-        return self.azimuth_choices.index(self.response_azimuth)
+    def error(self):
+        return self.response_azimuth.astype(int) - self.true_azimuth
+
+    def error_distribution(self):
+        errors, counts = np.unique(self.error, return_counts=True)
+        return dict(zip(errors.tolist(), counts.tolist()))
+
+    def to_responses(self):
+        shared_choices = {}
+        return [
+            Response(
+                true_azimuth=true_azimuth,
+                response_azimuth=response_azimuth,
+                filename=filename,
+                azimuth_choices=shared_choices.setdefault(azimuth_choices, azimuth_choices),
+                response_delay_ms=response_delay_ms,
+                true_index=true_index,
+                response_index=response_index,
+            )
+            for (
+                true_azimuth,
+                response_azimuth,
+                filename,
+                azimuth_choices,
+                response_delay_ms,
+                true_index,
+                response_index,
+            ) in zip(
+                self.true_azimuth.tolist(),
+                self.response_azimuth.tolist(),
+                self.filename.tolist(),
+                map(tuple, self.azimuth_choices.tolist()),
+                self.response_delay_ms.tolist(),
+                self.true_index.tolist(),
+                self.response_index.tolist(),
+            )
+        ]
 
 
 @dataclass
 class Block:
     center_azimuth: int
-    responses: List[Response]
+    table: ResponseTable
+
+    @property
+    def responses(self):
+        return self.table.to_responses()
 
     @property
     def num_responses(self):
-        return len(self.responses)
+        return len(self.table)
 
     @cached_property
     def is_flagged(self):
@@ -45,7 +178,7 @@ class Block:
 
     @property
     def num_correct_responses(self):
-        return len([r for r in self.responses if r.is_correct])
+        return int(np.count_nonzero(self.table.is_correct))
 
     @property
     def fraction_correct_responses(self):
@@ -53,21 +186,11 @@ class Block:
 
     @property
     def average_error(self):
-        errors = []
-        for response in self.responses:
-            error = abs(response.error)
-            errors.append(error)
-        return sum(errors) / len(errors)
+        return float(np.abs(self.table.error).mean())
 
     @property
     def error_distribution(self):
-        errors = {}
-        for response in self.responses:
-            error = response.error
-            if not errors.get(error):
-                errors[error] = 0
-            errors[error] += 1
-        return errors
+        return self.table.error_distribution()
 
 
 @dataclass
@@ -82,49 +205,90 @@ class Participant:
     slowdown: int
     sex: str
     age: int
-    blocks: List[Block]
+    table: ResponseTable
+    _derived: Optional[BoundedCache] = field(default=None, repr=False, compare=False)
 
-    def _get_blocks(self, sector=None):
-        if sector == "left":
-            return [b for b in self.blocks if b.center_azimuth < 0]
-        elif sector == "right":
-            return [b for b in self.blocks if b.center_azimuth > 0]
-        elif sector == "center":
-            return [b for b in self.blocks if b.center_azimuth == 0]
-        return self.blocks
+    # Upper bound on cached derived results (matrices, sensitivities...) per participant
+    max_derived_results = 32
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_derived"] = None
+        return state
+
+    def _get_derived(self, key, compute):
+        if self._derived is None:
+            self._derived = BoundedCache(Participant.max_derived_results)
+        return self._derived.get_or_compute(key, compute)
+
+    def invalidate_derived(self):
+        if self._derived is not None:
+            self._derived.clear()
+
+    def get_confusion_matrix(self, sector=None, kind="indices"):
+        from confusion import ConfusionMatrix
+
+        def compute():
+            table = self.get_table(sector)
+            if kind == "indices":
+                matrix = ConfusionMatrix.of_indices(table)
+            elif kind == "azimuths":
+                matrix = ConfusionMatrix.of_azimuths(table)
+            else:
+                raise ValueError(f"Unknown confusion matrix kind {kind}")
+            matrix.totals.flags.writeable = False
+            return matrix
+
+        return self._get_derived(("confusion_matrix", kind, sector), compute)
+
+    def get_sensitivities(self, sector=None, epsilon=0.001, kind="indices"):
+        from sensitivity import get_interstim_sensitivities_for_confusion_matrix
+
+        def compute():
+            matrix = self.get_confusion_matrix(sector, kind)
+            return tuple(get_interstim_sensitivities_for_confusion_matrix(matrix, epsilon))
+
+        return list(self._get_derived(("sensitivities", kind, sector, epsilon), compute))
+
+    @cached_property
+    def blocks(self):
+        # Each block's responses are a contiguous run of rows with the same block_index
+        boundaries = np.flatnonzero(np.diff(self.table.block_index)) + 1
+        starts = [0, *boundaries.tolist()]
+        stops = [*boundaries.tolist(), len(self.table)]
+        return [
+            Block(
+                center_azimuth=int(self.table.center_azimuth[start]), table=self.table[start:stop]
+            )
+            for start, stop in zip(starts, stops)
+            if stop > start
+        ]
+
+    def get_table(self, sector=None):
+        return self.table.select(sector)
 
     def get_responses(self, sector=None):
-        blocks = self._get_blocks(sector)
-        return [response for block in blocks for response in block.responses]
+        return self.get_table(sector).to_responses()
 
     @cached_property
     def num_correct_responses(self):
-        correct = 0
-        for block in self._get_blocks():
-            correct += block.num_correct_responses
-        return correct
+        return int(np.count_nonzero(self.table.is_correct))
 
     @property
     def fraction_correct_responses(self):
-        total = 0
-        correct = 0
-        for block in self._get_blocks():
-            total += block.num_responses
-            correct += block.num_correct_responses
-        return correct / total
+        return float(self.table.is_correct.mean())
 
     @property
     def average_error(self):
-        errors = []
-        for block in self._get_blocks():
-            for response in block.responses:
-                error = response.error
-                errors.append(error)
-        return sum(errors) / len(errors)
+        return float(self.table.error.mean())
 
     @property
     def error_distribution(self):
-        return merge_distributions([block.error_distribution for block in self._get_blocks()])
+        distribution = self._get_derived(
+            ("error_distribution",),
+            lambda: merge_distributions([self.table.error_distribution()]),
+        )
+        return dict(distribution)
 
     @cached_property
     def is_flagged(self):
@@ -141,6 +305,7 @@ class Participant:
 
 class ParticipantException(Exception):
     def __init__(self, prolific_pid, reason):
+        super().__init__(prolific_pid, reason)
         self.prolific_pid = prolific_pid
         self.reason = reason
-        self.message = f"[{prolific_pid}] {reason}"
\ No newline at end of file
+        self.message = f"[{prolific_pid}] {reason}"
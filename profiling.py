@@ -0,0 +1,171 @@
+from contextlib import contextmanager
+from functools import wraps
+from os import environ, getpid
+import atexit
+import json
+import threading
+import time
+import tracemalloc
+
+# Setting ECHO_PROFILE=1 profiles the whole run and prints a summary at exit, also writing a
+# Chrome trace (loadable in chrome://tracing, Perfetto or speedscope) if ECHO_PROFILE_TRACE is set.
+# Only stages run in this process are recorded, not those run by pool workers.
+env_var = "ECHO_PROFILE"
+trace_env_var = "ECHO_PROFILE_TRACE"
+
+_enabled = False
+_trace_memory = False
+_started_tracing = False
+# Peak traced memory seen so far by each open stage, innermost last
+_open_peaks = []
+_stats = {}
+_events = []
+_start_ns = 0
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    global _start_ns
+    _stats.clear()
+    _events.clear()
+    _start_ns = time.perf_counter_ns()
+
+
+def enable(trace_memory=True):
+    global _enabled, _trace_memory, _started_tracing
+    reset()
+    _enabled = True
+    _trace_memory = trace_memory
+    # Tracing someone else started is left running on disable()
+    _started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if _started_tracing:
+        tracemalloc.start()
+
+
+def disable():
+    global _enabled, _trace_memory, _started_tracing
+    if _started_tracing:
+        tracemalloc.stop()
+    _enabled = False
+    _trace_memory = False
+    _started_tracing = False
+
+
+@contextmanager
+def stage(name):
+    # Records one call of `name`. Times and memory are inclusive of nested stages: net bytes are
+    # the change in traced memory over the call, and peak bytes the most it rose above where it
+    # started. Peaks need tracemalloc.reset_peak() (Python 3.9+) and are None without it.
+    if not _enabled:
+        yield
+        return
+    track_peak = _trace_memory and hasattr(tracemalloc, "reset_peak")
+    start_bytes = tracemalloc.get_traced_memory()[0] if _trace_memory else 0
+    if track_peak:
+        # The traced peak is global, so fold it into the enclosing stages before resetting it
+        peak = tracemalloc.get_traced_memory()[1]
+        _open_peaks[:] = [max(open_peak, peak) for open_peak in _open_peaks]
+        tracemalloc.reset_peak()
+        _open_peaks.append(start_bytes)
+    start_ns = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        end_ns = time.perf_counter_ns()
+        net_bytes = 0
+        peak_bytes = None
+        if _trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            net_bytes = current - start_bytes
+        if track_peak:
+            peak_bytes = max(_open_peaks.pop(), peak) - start_bytes
+        stats = _stats.setdefault(
+            name, {"calls": 0, "seconds": 0.0, "net_bytes": 0, "peak_bytes": None}
+        )
+        stats["calls"] += 1
+        stats["seconds"] += (end_ns - start_ns) / 1e9
+        stats["net_bytes"] += net_bytes
+        if peak_bytes is not None:
+            stats["peak_bytes"] = max(stats["peak_bytes"] or 0, peak_bytes)
+        _events.append(
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (start_ns - _start_ns) / 1e3,
+                "dur": (end_ns - start_ns) / 1e3,
+                "pid": getpid(),
+                "tid": threading.get_ident(),
+                "args": {"net_bytes": net_bytes, "peak_bytes": peak_bytes},
+            }
+        )
+
+
+def timed(name):
+    # Decorator form of stage(), which costs a single flag check while profiling is off
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_summary():
+    rows = [{"stage": name, **stats} for name, stats in _stats.items()]
+    return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+
+def format_summary():
+    lines = [
+        f"{'stage':<32} {'calls':>8} {'seconds':>10} {'per call ms':>12} {'net MB':>10} "
+        f"{'peak MB':>10}"
+    ]
+    for row in get_summary():
+        per_call_ms = 1000 * row["seconds"] / row["calls"]
+        net_mb = row["net_bytes"] / 2**20
+        peak_mb = "-" if row["peak_bytes"] is None else f"{row['peak_bytes'] / 2**20:.2f}"
+        lines.append(
+            f"{row['stage']:<32} {row['calls']:>8} {row['seconds']:>10.3f} "
+            f"{per_call_ms:>12.3f} {net_mb:>10.2f} {peak_mb:>10}"
+        )
+    return "\n".join(lines)
+
+
+def write_trace(trace_path):
+    with open(trace_path, "w") as file:
+        json.dump({"traceEvents": _events, "displayTimeUnit": "ms"}, file)
+
+
+@contextmanager
+def profile(trace_path=None, trace_memory=True, verbose=True):
+    # Profiles the stages run inside the block, then prints the summary and writes the trace
+    enable(trace_memory)
+    try:
+        yield
+    finally:
+        disable()
+        if verbose:
+            print(format_summary())
+        if trace_path:
+            write_trace(trace_path)
+
+
+def _report_at_exit():
+    disable()
+    print(format_summary())
+    trace_path = environ.get(trace_env_var)
+    if trace_path:
+        write_trace(trace_path)
+
+
+if environ.get(env_var, "") not in ("", "0"):
+    enable()
+    atexit.register(_report_at_exit)
@@ -2,12 +2,13 @@ from typing import List
 from csv import DictReader
 from dataclasses import dataclass
 
+import numpy as np
 import pandas as pd
-import pingouin as pg
-from statsmodels.formula.api import ols
+from scipy.stats import f as f_distribution, norm
 
 
 from confusion import ConfusionMatrix
+from profiling import timed
 from sensitivity import get_interstim_sensitivities_for_confusion_matrix, InterstimSensitivities
 
 
@@ -59,28 +60,102 @@ def load_rmcorr_results():
     return results
 
 
-def _get_dataframe_for_sensitivities_by_participant(
+rm_corr_columns = ["slope", "r", "dof", "pval", "ci95_lower", "ci95_upper"]
+
+
+@timed("rmcorr.fit")
+def rm_corr(subject, x, y, groups=None):
+    # Repeated measures correlation (Bakdash & Marusich) of every group at once, from
+    # within-subject centering. Returns a DataFrame indexed by group with:
+    #   slope: the common within-subject slope, as in `y ~ C(subject) + x`
+    #   r, dof, pval: as pingouin.rm_corr, where dof = observations - subjects - 1
+    #   ci95_lower, ci95_upper: Fisher z interval of r (pingouin rounds these to 2 places)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if groups is None:
+        groups = np.zeros(len(x), dtype=int)
+    group_labels, group_codes = np.unique(np.asarray(groups), return_inverse=True)
+    _, subject_codes = np.unique(np.asarray(subject), return_inverse=True)
+    # A subject seen in two groups counts as separate subjects
+    cell_keys, cell_codes = np.unique(
+        np.stack([group_codes.ravel(), subject_codes.ravel()]), axis=1, return_inverse=True
+    )
+    cell_codes = cell_codes.ravel()
+    cell_counts = np.bincount(cell_codes)
+    x = x - (np.bincount(cell_codes, weights=x) / cell_counts)[cell_codes]
+    y = y - (np.bincount(cell_codes, weights=y) / cell_counts)[cell_codes]
+
+    num_groups = len(group_labels)
+    group_codes = group_codes.ravel()
+    sxy = np.bincount(group_codes, weights=x * y, minlength=num_groups)
+    sxx = np.bincount(group_codes, weights=x * x, minlength=num_groups)
+    syy = np.bincount(group_codes, weights=y * y, minlength=num_groups)
+    num_observations = np.bincount(group_codes, minlength=num_groups)
+    num_subjects = np.bincount(cell_keys[0], minlength=num_groups)
+    dof = num_observations - num_subjects - 1
+
+    slope = sxy / sxx
+    r = sxy / np.sqrt(sxx * syy)
+    # F test of the covariate against the within-subject residual, as in pingouin's ANCOVA
+    explained = sxy * slope
+    f_statistic = explained / ((syy - explained) / dof)
+    pval = f_distribution.sf(f_statistic, 1, dof)
+    # pingouin takes n = dof + 2 for the interval, so its standard error is 1 / sqrt(dof - 1)
+    margin = norm.ppf(0.975) / np.sqrt(dof - 1)
+    z = np.arctanh(r)
+    return pd.DataFrame(
+        {
+            "slope": slope,
+            "r": r,
+            "dof": dof,
+            "pval": pval,
+            "ci95_lower": np.tanh(z - margin),
+            "ci95_upper": np.tanh(z + margin),
+        },
+        index=pd.Index(group_labels, name="group"),
+        columns=rm_corr_columns,
+    )
+
+
+def _get_arrays_for_sensitivities_by_participant(
     sensitivities_by_participant: List[List[InterstimSensitivities]],
 ):
-    data = {"subject": [], "distance": [], "dprime": []}
-    for idx, sensitivities in enumerate(sensitivities_by_participant):
-        subject = str(idx)
-        for (distance, dprime) in sensitivities:
-            data["subject"].append(subject)
-            data["distance"].append(distance)
-            data["dprime"].append(dprime)
-    return pd.DataFrame(data)
+    lengths = [len(sensitivities) for sensitivities in sensitivities_by_participant]
+    pairs = np.array(
+        [pair for sensitivities in sensitivities_by_participant for pair in sensitivities],
+        dtype=float,
+    ).reshape(-1, 2)
+    subjects = np.repeat(np.arange(len(lengths)), lengths)
+    return subjects, pairs[:, 0], pairs[:, 1]
+
+
+def _get_rmcorr_tuple(result: pd.DataFrame):
+    (row,) = result.itertuples(index=False)
+    return row.slope, row.r, np.array([row.ci95_lower, row.ci95_upper]), row.pval
 
 
 def get_rmcorr_for_sensitivities_by_participant(
     sensitivities_by_participant: List[List[InterstimSensitivities]],
 ):
-    df = _get_dataframe_for_sensitivities_by_participant(sensitivities_by_participant)
-    model = ols("dprime ~ C(subject) + distance", data=df).fit()
-    rm_corr = pg.rm_corr(df, x="distance", y="dprime", subject="subject")
-    return (
-        model.params["distance"],
-        rm_corr.at["rm_corr", "r"],
-        rm_corr.at["rm_corr", "CI95%"],
-        rm_corr.at["rm_corr", "pval"],
+    return _get_rmcorr_tuple(
+        rm_corr(*_get_arrays_for_sensitivities_by_participant(sensitivities_by_participant))
     )
+
+
+def get_rmcorr_for_sensitivity_arrays(distances: np.ndarray, d_primes: np.ndarray):
+    distances = np.broadcast_to(distances, d_primes.shape)
+    subjects = np.repeat(np.arange(d_primes.shape[0]), d_primes.shape[1])
+    return _get_rmcorr_tuple(rm_corr(subjects, distances.ravel(), d_primes.ravel()))
+
+
+@timed("rmcorr.batched")
+def get_batched_rmcorr(distances: np.ndarray, dprimes: np.ndarray):
+    # Arrays are shaped (..., subjects, pairs). Demeaning each subject's row gives the
+    # `distance` coefficient of `dprime ~ C(subject) + distance` and pingouin's rm_corr r.
+    distances, dprimes = np.broadcast_arrays(distances, dprimes)
+    x = distances - distances.mean(axis=-1, keepdims=True)
+    y = dprimes - dprimes.mean(axis=-1, keepdims=True)
+    sxy = np.einsum("...sp,...sp->...", x, y)
+    sxx = np.einsum("...sp,...sp->...", x, x)
+    syy = np.einsum("...sp,...sp->...", y, y)
+    return sxy / sxx, sxy / np.sqrt(sxx * syy)
@@ -0,0 +1,136 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from csv import DictWriter
+from functools import partial
+from os import path
+
+import numpy as np
+
+from sensitivity import get_interstim_sensitivity_arrays
+from bootstrap import (
+    ResamplingPlan,
+    bootstrap_dprime_rmcorr_ci95,
+    bootstrap_dprime_rmcorr_ci95_adaptive,
+)
+from rmcorr import rm_corr
+
+filename = "rmcorr_analysis.csv"
+file_path = path.normpath(path.join(__file__, "..", filename))
+seed = 8675309
+sectors = ("left", "center", "right")
+
+columns = [
+    "slowdown",
+    "compensation_descriptor",
+    "count",
+    "sector",
+    "slope",
+    "rmcorr",
+    "pval",
+    "slope_ci95_lower",
+    "slope_median",
+    "slope_ci95_upper",
+    "rmcorr_ci95_lower",
+    "rmcorr_median",
+    "rmcorr_ci95_upper",
+]
+# Written as well when the bootstrap runs adaptively
+convergence_columns = ["iterations", "mc_error"]
+
+
+def get_cells(study):
+    # One cell per condition, holding each sector's confusion matrices so that every sector is
+    # bootstrapped from the same resamples
+    conditions = study.subsect(slowdown=[12, 20], compensation_descriptor=["1", "half", "full"])
+    cells = []
+    for condition in conditions:
+        participants = condition.get()
+        confusion_matrices_by_sector = {
+            sector: [p.get_confusion_matrix(sector) for p in participants] for sector in sectors
+        }
+        cells.append((condition.values, condition.count(), confusion_matrices_by_sector))
+    return cells
+
+
+def run_cell(cell, seed_sequence, sample_size=12, iterations=10000, tolerance=None):
+    values, count, confusion_matrices_by_sector = cell
+    rng = np.random.default_rng(seed_sequence)
+    plan = ResamplingPlan.draw(count, sample_size, iterations, rng)
+    # Point estimates for every sector come from one rm_corr call, grouped by sector
+    subjects, distances, d_primes, groups = [], [], [], []
+    for sector, confusion_matrices in confusion_matrices_by_sector.items():
+        sector_distances, sector_d_primes = get_interstim_sensitivity_arrays(
+            np.stack([cm.totals for cm in confusion_matrices])
+        )
+        subjects.append(np.indices(sector_d_primes.shape)[0].ravel())
+        distances.append(sector_distances.ravel())
+        d_primes.append(sector_d_primes.ravel())
+        groups.append(np.full(sector_d_primes.size, sector))
+    estimates = rm_corr(
+        np.concatenate(subjects),
+        np.concatenate(distances),
+        np.concatenate(d_primes),
+        groups=np.concatenate(groups),
+    )
+    rows = []
+    for sector, confusion_matrices in confusion_matrices_by_sector.items():
+        slope, rmcorr, pval = estimates.loc[sector, ["slope", "r", "pval"]]
+        convergence = None
+        if tolerance is None:
+            slope_ci95, rmcorr_ci95 = bootstrap_dprime_rmcorr_ci95(confusion_matrices, plan=plan)
+        else:
+            slope_ci95, rmcorr_ci95, convergence = bootstrap_dprime_rmcorr_ci95_adaptive(
+                confusion_matrices, tolerance, plan=plan
+            )
+        slope_ci95_lower, slope_median, slope_ci95_upper = slope_ci95
+        rmcorr_ci95_lower, rmcorr_median, rmcorr_ci95_upper = rmcorr_ci95
+        row = {
+            "slowdown": values["slowdown"],
+            "compensation_descriptor": values["compensation_descriptor"],
+            "count": count,
+            "sector": sector,
+            "slope": slope,
+            "rmcorr": rmcorr,
+            "pval": pval,
+            "slope_ci95_lower": slope_ci95_lower,
+            "slope_median": slope_median,
+            "slope_ci95_upper": slope_ci95_upper,
+            "rmcorr_ci95_lower": rmcorr_ci95_lower,
+            "rmcorr_median": rmcorr_median,
+            "rmcorr_ci95_upper": rmcorr_ci95_upper,
+        }
+        if convergence:
+            row["iterations"] = convergence.iterations
+            row["mc_error"] = convergence.mc_error
+        rows.append(row)
+    return rows
+
+
+def run(study, workers=None, output_path=file_path, tolerance=None):
+    cells = get_cells(study)
+    # One child seed per cell, in cell order, so results don't depend on scheduling
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(cells))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        cell_rows = executor.map(partial(run_cell, tolerance=tolerance), cells, seed_sequences)
+        rows = [row for rows in cell_rows for row in rows]
+    with open(output_path, "w") as file:
+        writer = DictWriter(file, columns if tolerance is None else columns + convergence_columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=f"Regenerate {filename}")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default=file_path)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=None,
+        help="Stop each bootstrap once its CI endpoints' Monte-Carlo error is below this",
+    )
+    args = parser.parse_args()
+
+    from loader import echo_study
+
+    run(echo_study, workers=args.workers, output_path=args.output, tolerance=args.tolerance)
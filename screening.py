@@ -0,0 +1,193 @@
+from dataclasses import dataclass
+from functools import cached_property
+from typing import List, Optional
+
+import numpy as np
+from scipy.special import bdtr
+
+from util import get_longest_runs
+
+sectors = ("left", "center", "right")
+
+
+@dataclass
+class BlockIndex:
+    # Maps the rows of a response table, ordered by participant then block, onto the blocks they
+    # belong to
+    ids: np.ndarray
+    starts: np.ndarray
+    sizes: np.ndarray
+    participants: np.ndarray
+    block_indices: np.ndarray
+    centers: np.ndarray
+
+    @staticmethod
+    def of_table(table):
+        num_rows = len(table)
+        new_block = np.ones(num_rows, dtype=bool)
+        new_block[1:] = (np.diff(table.participant_index) != 0) | (np.diff(table.block_index) != 0)
+        starts = np.flatnonzero(new_block)
+        return BlockIndex(
+            ids=np.cumsum(new_block) - 1,
+            starts=starts,
+            sizes=np.diff(np.append(starts, num_rows)),
+            participants=table.participant_index[starts].astype(int),
+            block_indices=table.block_index[starts].astype(int),
+            centers=table.center_azimuth[starts].astype(int),
+        )
+
+    @property
+    def count(self):
+        return len(self.starts)
+
+    def in_sector(self, sector=None):
+        if sector is None:
+            return np.ones(self.count, dtype=bool)
+        return _get_sector_codes(self.centers) == sectors.index(sector)
+
+    def get_fractions(self, row_mask: np.ndarray):
+        # Fraction of each block's rows where row_mask holds
+        return np.bincount(self.ids, weights=row_mask, minlength=self.count) / self.sizes
+
+
+def _get_sector_codes(center_azimuths: np.ndarray):
+    # Positions in `sectors`: left of center, at center, right of center
+    return np.sign(center_azimuths).astype(int) + 1
+
+
+@dataclass
+class RunLengthRule:
+    # A block whose longest run of one reported azimuth exceeds max_run, as flag_block checks
+    max_run: int = 10
+    sector: Optional[str] = "center"
+    name: str = "run-length"
+
+    def evaluate(self, table, blocks: BlockIndex):
+        longest = get_longest_runs(table.response_azimuth, blocks.ids, blocks.count)
+        return (longest > self.max_run) & blocks.in_sector(self.sector)
+
+
+@dataclass
+class DelayOutlierRule:
+    # A block where more than max_fraction of responses have response delays whose robust z-score
+    # (of log delay, by median and MAD over the whole table) is beyond z_threshold
+    z_threshold: float = 3.5
+    max_fraction: float = 0.5
+    sector: Optional[str] = None
+    name: str = "delay-outliers"
+
+    def evaluate(self, table, blocks: BlockIndex):
+        log_delays = np.log(np.maximum(table.response_delay_ms, 1))
+        median = np.median(log_delays)
+        mad = np.median(np.abs(log_delays - median))
+        if mad == 0:
+            return np.zeros(blocks.count, dtype=bool)
+        z_scores = 0.6745 * (log_delays - median) / mad
+        fractions = blocks.get_fractions(np.abs(z_scores) > self.z_threshold)
+        return (fractions > self.max_fraction) & blocks.in_sector(self.sector)
+
+
+@dataclass
+class KeyDominanceRule:
+    # A block where a single response key accounts for more than max_fraction of the responses
+    max_fraction: float = 0.8
+    sector: Optional[str] = None
+    name: str = "key-dominance"
+
+    def evaluate(self, table, blocks: BlockIndex):
+        # Shifted so that responses outside the choices (-1) count as a key of their own
+        keys = table.response_index.astype(int) + 1
+        num_keys = int(keys.max()) + 1 if len(keys) else 1
+        counts = np.bincount(blocks.ids * num_keys + keys, minlength=blocks.count * num_keys)
+        dominant = counts.reshape(blocks.count, num_keys).max(axis=1)
+        return (dominant / blocks.sizes > self.max_fraction) & blocks.in_sector(self.sector)
+
+
+@dataclass
+class BelowChanceRule:
+    # Every block of a participant's sector where a one-sided binomial test of their correct
+    # responses over the sector rejects accuracy at chance (one over the number of choices) in
+    # favour of below it, at level alpha. A sector holds only a few dozen responses, so a point
+    # estimate below chance is common for participants guessing at chance.
+    alpha: float = 0.01
+    sector: Optional[str] = None
+    name: str = "below-chance"
+
+    def evaluate(self, table, blocks: BlockIndex):
+        num_groups = (int(blocks.participants.max()) + 1) * len(sectors) if blocks.count else 0
+        groups = table.participant_index.astype(int) * len(sectors)
+        groups += _get_sector_codes(table.center_azimuth)
+        totals = np.bincount(groups, minlength=num_groups)
+        correct = np.bincount(groups, weights=table.is_correct, minlength=num_groups)
+        chance = 1 / table.azimuth_choices.shape[1] if len(table) else 0
+        # bdtr is the binomial CDF, without importing all of scipy.stats
+        below = (totals > 0) & (bdtr(correct.astype(int), totals, chance) < self.alpha)
+        block_groups = blocks.participants * len(sectors) + _get_sector_codes(blocks.centers)
+        return below[block_groups] & blocks.in_sector(self.sector)
+
+
+default_rules = [RunLengthRule(), DelayOutlierRule(), KeyDominanceRule(), BelowChanceRule()]
+
+
+@dataclass
+class ScreeningResult:
+    # One row of flags per block and one column per rule, with the participant position (into
+    # the screened participants), block index and center azimuth of each row
+    rules: list
+    prolific_pids: List[str]
+    blocks: BlockIndex
+    flags: np.ndarray
+
+    @property
+    def rule_names(self):
+        return [rule.name for rule in self.rules]
+
+    @property
+    def block_flagged(self):
+        return self.flags.any(axis=1)
+
+    @cached_property
+    def participant_flags(self):
+        # (participants x rules), set where any of the participant's blocks is flagged
+        counts = np.zeros((len(self.prolific_pids), len(self.rule_names)), dtype=int)
+        np.add.at(counts, self.blocks.participants, self.flags)
+        return counts > 0
+
+    @property
+    def participant_flagged(self):
+        return self.participant_flags.any(axis=1)
+
+    def get_reasons(self, position: int):
+        flags = self.participant_flags[position]
+        return [name for name, flag in zip(self.rule_names, flags) if flag]
+
+    def get_flagged_pids(self):
+        return {
+            self.prolific_pids[position]: self.get_reasons(position)
+            for position in np.flatnonzero(self.participant_flagged).tolist()
+        }
+
+    def to_frame(self):
+        import pandas as pd
+
+        pids = np.array(self.prolific_pids, dtype=object)
+        frame = pd.DataFrame(
+            {
+                "participant_id": pids[self.blocks.participants],
+                "block_index": self.blocks.block_indices,
+                "center_azimuth": self.blocks.centers,
+            }
+        )
+        for position, name in enumerate(self.rule_names):
+            frame[name] = self.flags[:, position]
+        return frame
+
+
+def screen_table(table, prolific_pids: List[str], rules=default_rules):
+    # Evaluates every rule over a table holding the responses of all participants, whose
+    # participant_index gives positions into prolific_pids
+    blocks = BlockIndex.of_table(table)
+    flags = np.zeros((blocks.count, len(rules)), dtype=bool)
+    for position, rule in enumerate(rules):
+        flags[:, position] = rule.evaluate(table, blocks)
+    return ScreeningResult(list(rules), list(prolific_pids), blocks, flags)
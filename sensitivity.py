@@ -1,15 +1,16 @@
 from typing import List, Tuple
-from functools import reduce
-from statistics import NormalDist
+from functools import reduce, lru_cache
 import numpy as np
-from scipy.optimize import curve_fit
+from scipy.special import ndtri
 
 from models import Participant
 from confusion import ConfusionMatrix
+from fitting import fit_lin, fit_log
+from profiling import timed
 from util import mean_of_matrices
 
 InterstimSensitivities = List[Tuple[int, float]]
-inverse_cdf = np.vectorize(NormalDist().inv_cdf)
+inverse_cdf = ndtri
 
 
 def get_individual_interstim_sensitivities_for_participants(
@@ -19,33 +20,39 @@ def get_individual_interstim_sensitivities_for_participants(
 ):
     all_sensitivities = []
     for part in participants:
-        confusion_matrix = ConfusionMatrix.of_indices(part.get_responses(sector=sector))
-        participant_sensitivities = get_interstim_sensitivities_for_confusion_matrix(
-            confusion_matrix,
-            epsilon,
-        )
-        all_sensitivities += participant_sensitivities
+        all_sensitivities += part.get_sensitivities(sector=sector, epsilon=epsilon)
     return all_sensitivities
 
 
+@lru_cache()
+def _get_interstim_pair_indices(size: int):
+    # Off-diagonal (true, reported) cells in row-major order, stably sorted by distance
+    true_indices, reported_indices = np.nonzero(~np.eye(size, dtype=bool))
+    distances = np.abs(reported_indices - true_indices)
+    order = np.argsort(distances, kind="stable")
+    return true_indices[order], reported_indices[order], distances[order]
+
+
+@timed("sensitivity.d_prime")
+def get_interstim_sensitivity_arrays(totals: np.ndarray, epsilon=0.001):
+    # Takes (..., k, k) confusion totals and returns (..., pairs) distance and d' arrays, in the
+    # same order as get_interstim_sensitivities_for_confusion_matrix
+    totals = np.asarray(totals, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        false_alarms = np.nan_to_num(totals / totals.sum(axis=-1, keepdims=True))
+    z_scores = inverse_cdf(np.clip(false_alarms, epsilon, 1 - epsilon))
+    true_indices, reported_indices, distances = _get_interstim_pair_indices(totals.shape[-1])
+    hits = np.diagonal(z_scores, axis1=-2, axis2=-1)[..., reported_indices]
+    d_primes = hits - z_scores[..., true_indices, reported_indices]
+    return np.broadcast_to(distances, d_primes.shape), d_primes
+
+
 def get_interstim_sensitivities_for_confusion_matrix(
     cm: ConfusionMatrix,
     epsilon=0.001,
 ) -> InterstimSensitivities:
-    false_alarms = cm.true_values_sum_to_unity
-    regularized_false_alarms = np.clip(false_alarms, epsilon, 1 - epsilon)
-    num_responses = regularized_false_alarms.shape[0]
-    hits = np.tile(regularized_false_alarms.diagonal(), (num_responses, 1))
-    d_prime = inverse_cdf(hits) - inverse_cdf(regularized_false_alarms)
-    distances = []
-    for i in range(num_responses):
-        for j in range(num_responses):
-            interstim_distance = abs(j - i)
-            if interstim_distance == 0:
-                continue
-            value = d_prime[i, j]
-            distances.append((interstim_distance, value))
-    return list(sorted(distances, key=lambda x: x[0]))
+    distances, d_primes = get_interstim_sensitivity_arrays(cm.totals, epsilon)
+    return list(zip(distances.tolist(), d_primes.tolist()))
 
 
 def get_log(x: float, a_param: float, b_param: float) -> float:
@@ -63,27 +70,31 @@ def get_linspace_for_sensitivities(sensitivites: InterstimSensitivities, delta=0
     return np.linspace(min_distance, max_distance, 1 + round((max_distance - min_distance) / delta))
 
 
+@timed("sensitivity.log_fit")
 def log_fit_sensitivities(sensitivites: InterstimSensitivities):
     x, y = zip(*sensitivites)
-    popt, _ = curve_fit(get_log, x, y)
+    popt, _ = fit_log(x, y)
     x_interpolated = get_linspace_for_sensitivities(sensitivites)
     y_interpolated = get_log(x_interpolated, *popt)
     return x_interpolated, y_interpolated
 
 
+@timed("sensitivity.lin_fit")
 def lin_fit_sensitivities(sensitivites: InterstimSensitivities):
     x, y = zip(*sensitivites)
-    popt, _ = curve_fit(get_lin, x, y)
+    popt, _ = fit_lin(x, y)
     x_interpolated = get_linspace_for_sensitivities(sensitivites)
     y_interpolated = get_lin(x_interpolated, *popt)
     return x_interpolated, y_interpolated
 
 
+@timed("sensitivity.multilinear_fit")
 def multilinear_fit_sensitivities(sensitivities: InterstimSensitivities):
-    x = []
-    y = []
-    for distance in range(1, 5):
-        mean = np.mean([s[1] for s in sensitivities if s[0] == distance])
-        x.append(distance)
-        y.append(mean)
-    return x, y
\ No newline at end of file
+    # Mean d' at each distance from 1 to 4, grouped in a single pass
+    distances, d_primes = np.array(sensitivities, dtype=float).reshape(-1, 2).T
+    distances = distances.astype(int)
+    counts = np.bincount(distances, minlength=5)[1:5]
+    sums = np.bincount(distances, weights=d_primes, minlength=5)[1:5]
+    with np.errstate(invalid="ignore"):
+        means = sums / counts
+    return list(range(1, 5)), means.tolist()
\ No newline at end of file
@@ -1,19 +1,28 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import signal
-from scipy.io import wavfile
+
+from stimuli import compute_features, get_features, stft_params
 
 def plot_spectrogram(filename):
-    sample_rate, samples = wavfile.read(filename)
+    # Reads the spectrogram from the feature store (see stimuli.py) when it's there
+    features = get_features(filename) or compute_features(filename)
     fig, axes = plt.subplots(nrows=2, ncols=1)
-    print(samples.shape)
+    print(features.spectrogram.shape)
+    # Padding for the first and last segments, as in Axes.specgram
+    pad = (stft_params["nfft"] - stft_params["noverlap"]) / features.sample_rate / 2
+    extent = (
+        features.times.min() - pad,
+        features.times.max() + pad,
+        features.freqs[0],
+        features.freqs[-1],
+    )
     for idx in (0,1):
         ax = axes[idx]
-        channel = np.clip(samples[:, idx], a_min=0, a_max=None)
-        ax.specgram(channel, Fs=sample_rate, scale='dB', NFFT=1024, scale_by_freq=False)
+        ax.imshow(np.flipud(10 * np.log10(features.spectrogram[idx])), extent=extent, aspect='auto')
         ax.set_ylim(ymin=0, ymax=6e3)
         ax.set_ylabel('Frequency (Hz)')
         ax.set_xlabel('Time (sec)')
     plt.show()
 
-plot_spectrogram("./supernormal-echolocation-presentations/media/audio/stims/spherical_chirp_300cm_s20_c1_cd-1_matched_a45.wav")
\ No newline at end of file
+if __name__ == "__main__":
+    plot_spectrogram("./supernormal-echolocation-presentations/media/audio/stims/spherical_chirp_300cm_s20_c1_cd-1_matched_a45.wav")
@@ -0,0 +1,293 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from os import listdir, makedirs, path, remove
+
+import numpy as np
+import pandas as pd
+from matplotlib import mlab
+from scipy.io import wavfile
+
+from loader import get_file_signature
+from models import ResponseTable
+from util import atomic_output_path, hash_file, read_json, write_json
+
+stims_dir = path.normpath(
+    path.join(__file__, "..", "supernormal-echolocation-presentations", "media", "audio", "stims")
+)
+store_dir = path.normpath(path.join(__file__, "..", ".stimulus_features"))
+index_filename = "index.json"
+cues_filename = "cues.json"
+
+# The spectrogram spectrograms.plot_spectrogram draws: a PSD per half-wave rectified channel, as
+# computed by matplotlib's specgram. Changing these rebuilds the store.
+stft_params = {"nfft": 1024, "noverlap": 128, "rectify": True}
+
+# ITD is searched within +/- max_itd_ms. Spectral notches are the deepest dip in the smoothed
+# magnitude spectrum within the notch band, as for pinna notches.
+cue_params = {"max_itd_ms": 1.0, "notch_band_hz": [4000, 16000], "smoothing_hz": 250}
+cue_columns = [
+    "ild_db",
+    "itd_ms",
+    "notch_hz_left",
+    "notch_depth_db_left",
+    "notch_hz_right",
+    "notch_depth_db_right",
+]
+
+
+@dataclass
+class StimulusFeatures:
+    sample_rate: int
+    freqs: np.ndarray
+    times: np.ndarray
+    # (channels x freqs x frames), memory-mapped when loaded from the store
+    spectrogram: np.ndarray
+
+
+def get_stimulus_paths(parent_dir=stims_dir):
+    return sorted(path.join(parent_dir, f) for f in listdir(parent_dir) if f.endswith(".wav"))
+
+
+def get_stimulus_key(filename):
+    # Response.filename values are relative to the presentations repo, so stimuli are keyed by
+    # basename
+    return path.basename(filename)
+
+
+def _get_freqs_and_times(sample_rate, num_frames, params=stft_params):
+    nfft = params["nfft"]
+    freqs = np.arange(nfft // 2 + 1) * sample_rate / nfft
+    times = (nfft / 2 + np.arange(num_frames) * (nfft - params["noverlap"])) / sample_rate
+    return freqs, times
+
+
+def compute_features(wav_path, params=stft_params):
+    # The WAV is memory-mapped, so only the channel being transformed is read into memory
+    sample_rate, samples = wavfile.read(wav_path, mmap=True)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    channels = []
+    for idx in range(samples.shape[1]):
+        channel = np.asarray(samples[:, idx])
+        if params["rectify"]:
+            channel = np.clip(channel, a_min=0, a_max=None)
+        spec, _, _ = mlab.specgram(
+            channel,
+            NFFT=params["nfft"],
+            Fs=sample_rate,
+            noverlap=params["noverlap"],
+            scale_by_freq=False,
+        )
+        channels.append(spec)
+    spectrogram = np.stack(channels).astype(np.float32)
+    freqs, times = _get_freqs_and_times(sample_rate, spectrogram.shape[-1], params)
+    return StimulusFeatures(sample_rate, freqs, times, spectrogram)
+
+
+def _compute_and_save(wav_path, digest, feature_dir):
+    features = compute_features(wav_path)
+    feature_file = f"{digest}.npy"
+    # np.save appends .npy to paths without it
+    with atomic_output_path(path.join(feature_dir, feature_file), ".tmp.npy") as temp_path:
+        np.save(temp_path, features.spectrogram)
+    return {"file": feature_file, "sample_rate": int(features.sample_rate)}
+
+
+def _read_index(index_path, params):
+    index = read_json(index_path)
+    return index if index and index.get("params") == params else None
+
+
+def load_index(feature_dir=store_dir):
+    return _read_index(path.join(feature_dir, index_filename), stft_params)
+
+
+def _split_stimuli(wav_paths, previous_entries, is_stored=lambda entry: True):
+    # Keeps the entries of stimuli whose content hash hasn't changed, and returns the rest as
+    # pending (wav_path, digest, signature) by key
+    entries = {}
+    pending = {}
+    for wav_path in wav_paths:
+        key = get_stimulus_key(wav_path)
+        entry = previous_entries.get(key)
+        signature = list(get_file_signature(wav_path))
+        digest = entry["hash"] if entry and entry["signature"] == signature else hash_file(wav_path)
+        if entry and entry["hash"] == digest and is_stored(entry):
+            entries[key] = {**entry, "signature": signature}
+        else:
+            pending[key] = (wav_path, digest, signature)
+    return entries, pending
+
+
+def _process_pending(pending, compute, workers, *args):
+    # Runs compute(wav_path, digest, *args) on a process pool, once per distinct content, and
+    # returns the new entries by key
+    if not pending:
+        return {}
+    paths_by_digest = {digest: wav_path for wav_path, digest, _ in pending.values()}
+    digests = list(paths_by_digest)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            compute,
+            [paths_by_digest[digest] for digest in digests],
+            digests,
+            *([arg] * len(digests) for arg in args),
+        )
+        results_by_digest = dict(zip(digests, results))
+    return {
+        key: {**results_by_digest[digest], "hash": digest, "signature": signature}
+        for key, (_, digest, signature) in pending.items()
+    }
+
+
+def build_feature_store(wav_paths=None, feature_dir=store_dir, workers=None):
+    # Computes features for stimuli whose content hash isn't in the index yet, on a process pool,
+    # and drops entries (and feature files) for stimuli that are gone. Stimuli with identical
+    # content share one feature file.
+    if wav_paths is None:
+        wav_paths = get_stimulus_paths()
+    makedirs(feature_dir, exist_ok=True)
+    previous_entries = (load_index(feature_dir) or {}).get("entries", {})
+    entries, pending = _split_stimuli(
+        wav_paths,
+        previous_entries,
+        lambda entry: path.exists(path.join(feature_dir, entry["file"])),
+    )
+    entries.update(_process_pending(pending, _compute_and_save, workers, feature_dir))
+
+    referenced = {entry["file"] for entry in entries.values()}
+    for filename in listdir(feature_dir):
+        if filename.endswith(".npy") and filename not in referenced:
+            remove(path.join(feature_dir, filename))
+    index = {"params": stft_params, "entries": entries}
+    write_json(path.join(feature_dir, index_filename), index)
+    return index
+
+
+def get_features(filename, index=None, feature_dir=store_dir):
+    # Looks a stimulus up by its filename (any path prefix), or returns None if it isn't stored
+    if index is None:
+        index = load_index(feature_dir)
+    entry = index and index["entries"].get(get_stimulus_key(filename))
+    if entry is None:
+        return None
+    spectrogram = np.load(path.join(feature_dir, entry["file"]), mmap_mode="r")
+    freqs, times = _get_freqs_and_times(entry["sample_rate"], spectrogram.shape[-1])
+    return StimulusFeatures(entry["sample_rate"], freqs, times, spectrogram)
+
+
+def _get_notches(spectra: np.ndarray, freqs: np.ndarray, params=cue_params):
+    # (channels x freqs) magnitude spectra -> per channel notch frequency and depth below the
+    # band's median level
+    bin_width = freqs[1] - freqs[0]
+    kernel_size = max(1, int(round(params["smoothing_hz"] / bin_width)))
+    kernel = np.ones(kernel_size) / kernel_size
+    smoothed = np.stack([np.convolve(spectrum, kernel, mode="same") for spectrum in spectra])
+    levels = 20 * np.log10(np.maximum(smoothed, np.finfo(float).tiny))
+    low, high = params["notch_band_hz"]
+    band = (freqs >= low) & (freqs <= high)
+    if not band.any():
+        return np.full(len(spectra), np.nan), np.full(len(spectra), np.nan)
+    band_levels = levels[:, band]
+    notches = band_levels.argmin(axis=1)
+    depths = np.median(band_levels, axis=1) - band_levels.min(axis=1)
+    return freqs[band][notches], depths
+
+
+def compute_cues(wav_path, params=cue_params):
+    # ILD is left over right energy. ITD is positive when the right channel lags the left,
+    # i.e. the source is to the left, from the peak of the FFT cross-correlation.
+    sample_rate, samples = wavfile.read(wav_path, mmap=True)
+    if samples.ndim != 2 or samples.shape[1] < 2:
+        raise ValueError(f"{wav_path} is not a binaural recording")
+    channels = np.asarray(samples[:, :2], dtype=float).T
+    energies = np.einsum("cn,cn->c", channels, channels)
+    ild_db = 10 * np.log10(energies[0] / energies[1])
+
+    num_samples = channels.shape[1]
+    size = 1 << int(np.ceil(np.log2(2 * num_samples)))
+    spectra = np.fft.rfft(channels, n=size, axis=1)
+    correlation = np.fft.irfft(spectra[0] * np.conj(spectra[1]), n=size)
+    max_lag = min(num_samples - 1, int(round(params["max_itd_ms"] * sample_rate / 1000)))
+    lags = np.arange(-max_lag, max_lag + 1)
+    peak_lag = lags[np.argmax(correlation[lags])]
+    itd_ms = -1000 * peak_lag / sample_rate
+
+    freqs = np.fft.rfftfreq(size, 1 / sample_rate)
+    notch_hz, notch_depth_db = _get_notches(np.abs(spectra), freqs, params)
+    return {
+        "ild_db": float(ild_db),
+        "itd_ms": float(itd_ms),
+        "notch_hz_left": float(notch_hz[0]),
+        "notch_depth_db_left": float(notch_depth_db[0]),
+        "notch_hz_right": float(notch_hz[1]),
+        "notch_depth_db_right": float(notch_depth_db[1]),
+    }
+
+
+def _compute_cues_entry(wav_path, digest):
+    return {"cues": compute_cues(wav_path)}
+
+
+def build_cue_table(wav_paths=None, feature_dir=store_dir, workers=None):
+    # Extracts cues for stimuli that are new or changed since the last run, so adding a stimulus
+    # set only processes its files. Returns a DataFrame of cues indexed by stimulus key.
+    if wav_paths is None:
+        wav_paths = get_stimulus_paths()
+    makedirs(feature_dir, exist_ok=True)
+    cues_path = path.join(feature_dir, cues_filename)
+    previous_entries = (_read_index(cues_path, cue_params) or {}).get("entries", {})
+    entries, pending = _split_stimuli(wav_paths, previous_entries)
+    entries.update(_process_pending(pending, _compute_cues_entry, workers))
+    if pending or len(entries) != len(previous_entries):
+        write_json(cues_path, {"params": cue_params, "entries": entries})
+    return _get_cue_frame(entries)
+
+
+def load_cue_table(feature_dir=store_dir):
+    index = _read_index(path.join(feature_dir, cues_filename), cue_params)
+    return _get_cue_frame(index["entries"] if index else {})
+
+
+def _get_cue_frame(entries):
+    keys = sorted(entries)
+    return pd.DataFrame(
+        [entries[key]["cues"] for key in keys],
+        index=pd.Index(keys, name="stimulus"),
+        columns=cue_columns,
+    )
+
+
+def get_response_cues(condition, cues: pd.DataFrame, sector=None):
+    # One row per response in the condition with the cues of its stimulus, joined on the
+    # filename's basename. Stimuli without cues get NaN.
+    participants = condition.get()
+    tables = [participant.get_table(sector) for participant in participants]
+    table = ResponseTable.concatenate(tables)
+    responses = pd.DataFrame(
+        {
+            "prolific_pid": np.repeat(
+                np.array([p.prolific_pid for p in participants], dtype=object),
+                [len(t) for t in tables],
+            ),
+            "block_index": table.block_index,
+            "true_azimuth": table.true_azimuth,
+            "response_azimuth": table.response_azimuth,
+            "error": table.error,
+            "filename": table.filename,
+            "stimulus": [get_stimulus_key(filename) for filename in table.filename],
+        }
+    )
+    return responses.join(cues, on="stimulus")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compute spectrograms and cues for every stimulus WAV")
+    parser.add_argument("--stims-dir", default=stims_dir)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    wav_paths = get_stimulus_paths(args.stims_dir)
+    index = build_feature_store(wav_paths, workers=args.workers)
+    cues = build_cue_table(wav_paths, workers=args.workers)
+    print(f"{len(index['entries'])} spectrograms and {len(cues)} cue sets in {store_dir}")
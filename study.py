@@ -1,11 +1,26 @@
 from statistics import mean, median, stdev
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from functools import cached_property
 from typing import List, Dict
 
-from models import Participant, ParticipantException
+from models import Participant, ParticipantException, ResponseTable
+from profiling import timed
+from screening import default_rules, screen_table
 
 import itertools
 
+import numpy as np
+
+indexed_fields = (
+    "version",
+    "model_name",
+    "slowdown",
+    "compensation",
+    "compensation_descriptor",
+    "keyset",
+    "sex",
+)
+
 
 def dict_product(dict_of_vals_or_lists):
     values = [v if isinstance(v, list) else [v] for v in dict_of_vals_or_lists.values()]
@@ -43,10 +58,36 @@ class Condition:
     participants: List[Participant]
     values: Dict[str, any]
 
+    @cached_property
+    def _query_index(self):
+        # Positions of participants by the value of each indexed field
+        index = {field: {} for field in indexed_fields}
+        for position, participant in enumerate(self.participants):
+            for field in indexed_fields:
+                index[field].setdefault(getattr(participant, field), set()).add(position)
+        return index
+
+    def _get_matching_positions(self, query_args):
+        positions = None
+        for key, value in query_args.items():
+            if key not in indexed_fields:
+                continue
+            values_index = self._query_index[key]
+            values = value if isinstance(value, list) else [value]
+            matches = set().union(*(values_index.get(v, ()) for v in values))
+            positions = matches if positions is None else positions & matches
+        if positions is None:
+            return range(len(self.participants))
+        return sorted(positions)
+
+    @timed("study.query")
     def query_participants(self, **kwargs):
         query_args, test = create_query(**kwargs)
+        participants = [self.participants[i] for i in self._get_matching_positions(query_args)]
+        if any(key not in indexed_fields for key in query_args):
+            participants = list(filter(test, participants))
         return Condition(
-            participants=list(filter(test, self.participants)),
+            participants=participants,
             values={**self.values, **query_args},
         )
 
@@ -54,19 +95,37 @@ class Condition:
         return self.participants
 
     def get_participants_responses(self, sector=None):
-        res = []
-        for part in self.participants:
-            responses = part.get_responses(sector)
-            for resp in responses:
-                res.append(resp)
-        return res
+        return self.get_responses_table(sector).to_responses()
+
+    def get_responses_table(self, sector=None):
+        return ResponseTable.concatenate([part.get_table(sector) for part in self.participants])
 
     def count(self):
         return len(self.participants)
 
+    def invalidate_derived(self):
+        for participant in self.participants:
+            participant.invalidate_derived()
+
+    @timed("study.subsect")
     def subsect(self, **kwargs):
-        queries = dict_product(kwargs)
-        return [self.query_participants(**query) for query in queries]
+        queries = [create_query(**query)[0] for query in dict_product(kwargs)]
+        if not queries:
+            return []
+        # Every query sets a single value for the same keys, so one pass that buckets
+        # participants by those values partitions them into all of the cells at once
+        keys = list(queries[0])
+        partition = {}
+        for participant in self.participants:
+            cell = tuple(getattr(participant, key) for key in keys)
+            partition.setdefault(cell, []).append(participant)
+        return [
+            Condition(
+                participants=partition.get(tuple(query_args[key] for key in keys), []),
+                values={**self.values, **query_args},
+            )
+            for query_args in queries
+        ]
 
     def age_breakdown(self):
         ages = []
@@ -105,12 +164,58 @@ class Condition:
 
 class Study(Condition):
     def __init__(self, participants: List[Participant], exceptions: List[ParticipantException]):
+        responses, participants = Study._build_responses_table(participants)
         super().__init__(participants=participants, values={})
         self.exceptions = exceptions
+        self.responses = responses
+        self.screening = None
+
+    @staticmethod
+    def _build_responses_table(participants: List[Participant]):
+        # Gather every participant's rows into one table and bind a copy of each participant to a
+        # view of its slice, so the study holds a single copy of each column. The participants
+        # passed in are left as they are, since other studies or the parse cache may share them.
+        tables = [participant.table for participant in participants]
+        responses = ResponseTable.concatenate(tables)
+        lengths = [len(table) for table in tables]
+        responses.participant_index[:] = np.repeat(np.arange(len(tables)), lengths)
+        stops = np.cumsum(lengths)
+        bound = [
+            replace(participant, table=responses[start:stop], _derived=None)
+            for participant, start, stop in zip(participants, stops - lengths, stops)
+        ]
+        return responses, bound
+
+    @timed("study.screen")
+    def screen(self, rules=default_rules):
+        self.screening = screen_table(
+            self.responses, [participant.prolific_pid for participant in self.participants], rules
+        )
+        return self.screening
+
+    def without_flagged(self):
+        # A new study of the participants that passed screening, rejecting the rest with the
+        # rules they failed as the reason
+        screening = self.screening or self.screen()
+        participants = []
+        exceptions = list(self.exceptions)
+        for position, participant in enumerate(self.participants):
+            reasons = screening.get_reasons(position)
+            if reasons:
+                reason = f"screened:{','.join(reasons)}"
+                exceptions.append(ParticipantException(participant.prolific_pid, reason))
+            else:
+                participants.append(participant)
+        study = Study(participants, exceptions)
+        study.screen(screening.rules)
+        return study
 
     def print_summary(self):
         print(f"✅ Loaded {len(self.participants)} entries")
         print(f"🚨 Rejected {len(self.exceptions)} entries")
+        num_flagged = 0 if self.screening is None else int(self.screening.participant_flagged.sum())
+        if num_flagged:
+            print(f"🚩 Flagged {num_flagged} entries")
 
     def spherical_vs_kemar(self, slowdown=20, compensation=20):
         return [
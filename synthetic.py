@@ -0,0 +1,126 @@
+from csv import DictWriter
+from os import makedirs, path
+
+import numpy as np
+
+version = "v1-up-stims"
+block_centers = (-45, 0, 45, 45, 0, -45)
+responses_per_block = 20
+choice_offsets = (-20, -10, 0, 10, 20)
+compensation_descriptors = ("1", "half", "full")
+slowdowns = (12, 20)
+model_names = ("spherical", "kemar")
+keysets = ("asdfg", "hjkl;")
+
+# Pavlovia exports carry many more columns than loader.py reads; a few extras keep the files
+# a realistic width for parsing benchmarks
+data_columns = [
+    "trial_type",
+    "trial_index",
+    "time_elapsed",
+    "rt",
+    "stimulus",
+    "prolificPid",
+    "version",
+    "userAgent",
+    "chosenKeyset",
+    "modelName",
+    "slowdown",
+    "compensation",
+    "compensationDescriptor",
+    "choices",
+    "azimuth",
+    "responseAzimuth",
+    "responseDelay",
+    "filename",
+    "internal_node_id",
+]
+metadata_columns = ["participant_id", "age", "Sex"]
+
+
+def _get_stimulus_filename(model_name, slowdown, compensation, compensation_descriptor, azimuth):
+    return (
+        f"media/audio/stims/{model_name}_chirp_300cm_s{slowdown}_c{compensation}"
+        f"_cd-{compensation_descriptor}_matched_a{azimuth}.wav"
+    )
+
+
+def generate_participant_rows(rng: np.random.Generator, prolific_pid: str):
+    slowdown = int(rng.choice(slowdowns))
+    compensation_descriptor = str(rng.choice(compensation_descriptors))
+    compensation = {"1": 1, "half": slowdown // 2, "full": slowdown}[compensation_descriptor]
+    model_name = str(rng.choice(model_names, p=(0.75, 0.25)))
+    skill = rng.uniform(0.2, 0.9)
+    common = {"prolificPid": prolific_pid, "version": version, "userAgent": "Mozilla/5.0"}
+    rows = [{**common, "trial_type": "keyset-select", "chosenKeyset": str(rng.choice(keysets))}]
+    for center in block_centers:
+        rows.append({**common, "trial_type": "block-bookend"})
+        choices = [center + offset for offset in choice_offsets]
+        true_indices = rng.integers(0, len(choices), responses_per_block)
+        # Correct with probability `skill`, otherwise off by one or two positions
+        misses = rng.choice((-2, -1, 1, 2), responses_per_block, p=(0.15, 0.35, 0.35, 0.15))
+        correct = rng.random(responses_per_block) < skill
+        response_indices = np.clip(np.where(correct, true_indices, true_indices + misses), 0, 4)
+        delays = rng.lognormal(7, 0.5, responses_per_block).astype(int)
+        for true_index, response_index, delay in zip(true_indices, response_indices, delays):
+            azimuth = choices[true_index]
+            rows.append(
+                {
+                    **common,
+                    "trial_type": "echo-presentation",
+                    "modelName": model_name,
+                    "slowdown": slowdown,
+                    "compensation": compensation,
+                    "compensationDescriptor": compensation_descriptor,
+                    "choices": ",".join(str(c) for c in choices),
+                    "azimuth": azimuth,
+                    "responseAzimuth": choices[response_index],
+                    "responseDelay": delay,
+                    "rt": delay,
+                    "filename": _get_stimulus_filename(
+                        model_name, slowdown, compensation, compensation_descriptor, azimuth
+                    ),
+                }
+            )
+        rows.append({**common, "trial_type": "html-keyboard-response", "stimulus": "<p>Rest</p>"})
+    rows.append({**common, "trial_type": "block-bookend"})
+    for index, row in enumerate(rows):
+        row["trial_index"] = index
+        row["time_elapsed"] = 1000 * index
+        row["internal_node_id"] = f"0.0-{index}.0"
+    return rows
+
+
+def write_synthetic_study(output_dir, num_participants, seed=0, start=0):
+    # Writes Pavlovia-format data files to output_dir/data and a prolific-style metadata export
+    # to output_dir/participant-metadata, returning both sets of paths
+    rng = np.random.default_rng(seed)
+    data_dir = path.join(output_dir, "data")
+    metadata_dir = path.join(output_dir, "participant-metadata")
+    makedirs(data_dir, exist_ok=True)
+    makedirs(metadata_dir, exist_ok=True)
+    data_file_paths = []
+    metadata_rows = []
+    for index in range(start, start + num_participants):
+        prolific_pid = f"{index:024x}"
+        data_file_path = path.join(data_dir, f"{prolific_pid}_echo_study.csv")
+        with open(data_file_path, "w", newline="") as file:
+            writer = DictWriter(file, data_columns)
+            writer.writeheader()
+            writer.writerows(generate_participant_rows(rng, prolific_pid))
+        data_file_paths.append(data_file_path)
+        metadata_rows.append(
+            {
+                "participant_id": prolific_pid,
+                "age": int(rng.integers(18, 60)),
+                "Sex": str(rng.choice(("Male", "Female"))),
+            }
+        )
+    metadata_file_path = path.join(
+        metadata_dir, f"synthetic_{start}_{start + num_participants}.csv"
+    )
+    with open(metadata_file_path, "w", newline="") as file:
+        writer = DictWriter(file, metadata_columns)
+        writer.writeheader()
+        writer.writerows(metadata_rows)
+    return data_file_paths, [metadata_file_path]
@@ -0,0 +1,24 @@
+import pytest
+
+import loader
+from models import ParticipantException
+from study import Study
+from synthetic import write_synthetic_study
+
+
+@pytest.fixture(scope="session")
+def synthetic_files(tmp_path_factory):
+    return write_synthetic_study(str(tmp_path_factory.mktemp("synthetic")), 30, seed=1)
+
+
+@pytest.fixture
+def synthetic_participants(synthetic_files):
+    data_file_paths, metadata_file_paths = synthetic_files
+    metadata_by_pid = loader.load_participant_metadata(metadata_file_paths)
+    results = loader.get_participants_for_files(data_file_paths, metadata_by_pid)
+    return [result for result in results if not isinstance(result, ParticipantException)]
+
+
+@pytest.fixture
+def synthetic_study(synthetic_participants):
+    return Study(synthetic_participants, [])
@@ -0,0 +1,26 @@
+import numpy as np
+
+from bootstrap import (
+    bootstrap_dprime_rmcorr_ci95,
+    bootstrap_dprime_rmcorr_ci95_adaptive,
+    bootstrap_dprime_slope,
+    bootstrap_dprime_slope_adaptive,
+)
+from confusion import ConfusionMatrix
+
+
+def test_fixed_and_adaptive_bootstraps_keep_their_shapes(synthetic_participants):
+    totals = ConfusionMatrix.stack_of_participants(synthetic_participants, "center")
+    overall, slopes = bootstrap_dprime_slope(totals, iterations=200, rng=np.random.default_rng(0))
+    assert len(overall) == 2 and len(slopes) == 200
+    assert len(bootstrap_dprime_rmcorr_ci95(totals, iterations=200)) == 2
+
+    # The 0.025th percentile's error can't be estimated until about 4,000 resamples
+    _, slopes, convergence = bootstrap_dprime_slope_adaptive(
+        totals, 1e9, rng=np.random.default_rng(0)
+    )
+    assert convergence.iterations == len(slopes) == 5000
+    *_, convergence = bootstrap_dprime_rmcorr_ci95_adaptive(
+        totals, 1e9, max_iterations=2000, rng=np.random.default_rng(0)
+    )
+    assert convergence.iterations == 2000 and convergence.mc_error == np.inf
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from confusion import ConfusionAccumulator, ConfusionMatrix
+
+
+def test_accumulating_participants_leaves_their_caches_empty(synthetic_participants):
+    accumulator = ConfusionAccumulator.of_participants(synthetic_participants, "left")
+    totals = ConfusionMatrix.stack_of_participants(synthetic_participants, "left")
+    assert accumulator.count == len(synthetic_participants)
+    assert np.allclose(accumulator.totals, totals.sum(axis=0))
+    assert all(participant._derived is None for participant in synthetic_participants)
+
+
+def test_empty_accumulator_raises_value_error():
+    accumulator = ConfusionAccumulator()
+    for attribute in ("mean_normalized", "normalized_standard_error", "pooled"):
+        with pytest.raises(ValueError):
+            getattr(accumulator, attribute)
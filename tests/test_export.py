@@ -0,0 +1,71 @@
+from os import listdir
+
+import pandas as pd
+
+import export
+import loader
+from study import Study
+
+
+def _get_exported_pids(participants):
+    return {
+        participant.prolific_pid
+        for participant in Study(participants, []).query_participants().get()
+    }
+
+
+def _sorted(frame):
+    return frame.sort_values(["participant_id", "sector", "dist_positions"]).reset_index(drop=True)
+
+
+def test_incremental_columnar_export_writes_and_rewrites_only_affected_parts(
+    tmp_path, monkeypatch, synthetic_files, synthetic_participants
+):
+    data_file_paths, metadata_file_paths = synthetic_files
+    monkeypatch.setattr(loader, "get_participant_metadata_file_paths", lambda: metadata_file_paths)
+    output_path = str(tmp_path / "export.parquet")
+    export.update_export(output_path, "parquet", data_file_paths[:20])
+    new_participants, dropped_pids = export.update_export(
+        output_path, "parquet", data_file_paths[:25]
+    )
+    added_pids = _get_exported_pids(synthetic_participants[20:25])
+    assert {participant.prolific_pid for participant in new_participants} == added_pids
+    assert not dropped_pids
+    assert sorted(listdir(output_path)) == ["part-00000.parquet", "part-00001.parquet"]
+
+    new_participants, dropped_pids = export.update_export(
+        output_path, "parquet", data_file_paths[20:25]
+    )
+    assert not new_participants
+    assert dropped_pids == _get_exported_pids(synthetic_participants[:20])
+    # The first part held only dropped participants, and the second wasn't touched
+    assert sorted(listdir(output_path)) == ["part-00001.parquet"]
+    frames = export.get_export_frames(
+        Study(synthetic_participants[20:25], []).query_participants().get()
+    )
+    expected = pd.concat(list(frames)).astype(export.column_types)
+    assert _sorted(export.load_export(output_path)).equals(_sorted(expected))
+
+
+def test_full_export_resets_the_incremental_manifest(
+    tmp_path, monkeypatch, synthetic_files, synthetic_participants
+):
+    data_file_paths, metadata_file_paths = synthetic_files
+    monkeypatch.setattr(loader, "get_participant_metadata_file_paths", lambda: metadata_file_paths)
+    output_path = str(tmp_path / "export.csv")
+    export.update_export(output_path, "csv", data_file_paths[:20])
+    export.update_export(str(tmp_path / "export.parquet"), "parquet", data_file_paths[:20])
+    assert sorted(listdir(tmp_path)) == [
+        "export.csv",
+        "export.csv.manifest.json",
+        "export.parquet",
+        "export.parquet.manifest.json",
+    ]
+    participants = Study(synthetic_participants, []).query_participants().get()
+    export.write_export(participants, output_path)
+    new_participants, _ = export.update_export(output_path, "csv", data_file_paths)
+    assert {participant.prolific_pid for participant in new_participants} == (
+        _get_exported_pids(synthetic_participants)
+    )
+    expected = pd.concat(list(export.get_export_frames(participants))).astype(export.column_types)
+    assert _sorted(export.load_export(output_path)).equals(_sorted(expected))
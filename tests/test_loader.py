@@ -0,0 +1,145 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+
+import loader
+from models import ParticipantException, ResponseTable
+
+
+def _read_rows(file_path):
+    with open(file_path, newline="") as file:
+        return list(csv.reader(file))
+
+
+def _write_rows(file_path, rows):
+    with open(file_path, "w", newline="") as file:
+        csv.writer(file, lineterminator="\n").writerows(rows)
+    return file_path
+
+
+def _get_echo_rows(rows):
+    trial_type = rows[0].index("trial_type")
+    return [i for i, row in enumerate(rows) if row[trial_type] == "echo-presentation"]
+
+
+def _assert_same_result(columnar, row_by_row):
+    if isinstance(row_by_row, ParticipantException):
+        assert isinstance(columnar, ParticipantException)
+        assert columnar.args == row_by_row.args
+        return
+    for name in ResponseTable.dtypes:
+        assert np.array_equal(getattr(columnar.table, name), getattr(row_by_row.table, name))
+    assert columnar.prolific_pid == row_by_row.prolific_pid
+    assert (columnar.version, columnar.slowdown, columnar.compensation, columnar.keyset) == (
+        row_by_row.version,
+        row_by_row.slowdown,
+        row_by_row.compensation,
+        row_by_row.keyset,
+    )
+
+
+def _edit_nothing(rows):
+    return rows
+
+
+def _remove_version_column(rows):
+    return [["no-version" if c == "version" else c for c in rows[0]], *rows[1:]]
+
+
+def _mark_invalid_partway(rows):
+    pid = rows[0].index("prolificPid")
+    for row in rows[50:]:
+        row[pid] = loader.invalid_prolific_pids[0]
+    return rows
+
+
+def _drop_a_response(rows):
+    rows[_get_echo_rows(rows)[5]][rows[0].index("responseAzimuth")] = ""
+    return rows
+
+
+def _set_nan_compensation(rows):
+    for index in _get_echo_rows(rows):
+        rows[index][rows[0].index("compensation")] = "NaN"
+    return rows
+
+
+def _add_a_choice_to_one_row(rows):
+    rows[_get_echo_rows(rows)[7]][rows[0].index("choices")] += ",99"
+    return rows
+
+
+def _add_a_choice_to_every_row(rows):
+    for index in _get_echo_rows(rows):
+        rows[index][rows[0].index("choices")] += ",99"
+    return rows
+
+
+def _shorten_a_row(rows):
+    rows[40] = rows[40][:5]
+    return rows
+
+
+def _remove_a_bookend(rows):
+    trial_type = rows[0].index("trial_type")
+    bookends = [i for i, row in enumerate(rows) if row[trial_type] == "block-bookend"]
+    del rows[bookends[2]]
+    return rows
+
+
+@pytest.mark.parametrize(
+    "edit",
+    [
+        _edit_nothing,
+        _remove_version_column,
+        _mark_invalid_partway,
+        _drop_a_response,
+        _set_nan_compensation,
+        _add_a_choice_to_one_row,
+        _add_a_choice_to_every_row,
+        _shorten_a_row,
+        _remove_a_bookend,
+    ],
+)
+def test_columnar_parser_matches_row_by_row_parser(synthetic_files, tmp_path, edit):
+    data_file_paths, metadata_file_paths = synthetic_files
+    metadata_by_pid = loader.load_participant_metadata(metadata_file_paths)
+    edited_path = _write_rows(
+        str(tmp_path / os.path.basename(data_file_paths[0])),
+        edit(_read_rows(data_file_paths[0])),
+    )
+    with open(data_file_paths[1]) as file:
+        text = file.read()
+    truncated_path = tmp_path / "truncated.csv"
+    truncated_path.write_text(text[: len(text) // 2])
+    header_only_path = tmp_path / "header_only.csv"
+    header_only_path.write_text(text.partition("\n")[0] + "\n")
+    empty_path = tmp_path / "empty.csv"
+    empty_path.write_text("")
+    file_paths = [
+        edited_path,
+        str(truncated_path),
+        str(header_only_path),
+        str(empty_path),
+        *data_file_paths[2:],
+    ]
+    columnar = loader.get_participants_for_files(file_paths, metadata_by_pid)
+    for file_path, result in zip(file_paths, columnar):
+        _assert_same_result(result, loader._parse_file(file_path, metadata_by_pid))
+
+
+def test_ragged_choices_only_exclude_their_file(synthetic_files, tmp_path):
+    data_file_paths, metadata_file_paths = synthetic_files
+    metadata_by_pid = loader.load_participant_metadata(metadata_file_paths)
+    ragged_path = _write_rows(
+        str(tmp_path / "ragged.csv"), _add_a_choice_to_one_row(_read_rows(data_file_paths[0]))
+    )
+    results = loader.get_participants_for_files(
+        [ragged_path, *data_file_paths[1:]], metadata_by_pid
+    )
+    assert isinstance(results[0], ParticipantException)
+    assert results[0].reason == "ragged-choices"
+    for file_path, result in zip(data_file_paths[1:], results[1:]):
+        _assert_same_result(result, loader._parse_file(file_path, metadata_by_pid))
@@ -0,0 +1,35 @@
+import sys
+import tracemalloc
+
+import pytest
+
+import profiling
+
+
+@pytest.mark.skipif(sys.version_info < (3, 9), reason="tracemalloc.reset_peak is 3.9+")
+def test_stages_report_their_peak_memory():
+    with profiling.profile(verbose=False):
+        with profiling.stage("outer"):
+            with profiling.stage("inner"):
+                block = bytearray(8 * 2**20)
+                del block
+            with profiling.stage("after"):
+                pass
+    stats = {row["stage"]: row for row in profiling.get_summary()}
+    assert stats["inner"]["peak_bytes"] >= 8 * 2**20
+    assert stats["outer"]["peak_bytes"] >= 8 * 2**20
+    assert stats["after"]["peak_bytes"] < 2**20
+    assert abs(stats["inner"]["net_bytes"]) < 2**20
+
+
+def test_disable_leaves_tracing_it_did_not_start():
+    tracemalloc.start()
+    try:
+        with profiling.profile(verbose=False):
+            pass
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+    with profiling.profile(verbose=False):
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,49 @@
+import numpy as np
+
+from models import ResponseTable
+from screening import BelowChanceRule, BlockIndex
+
+choices = [-20, -10, 0, 10, 20]
+
+
+def _get_center_table(correct_counts, responses_per_participant=40):
+    # One participant per count, with two center blocks of 20 responses whose first `count` are
+    # correct and the rest one position off
+    num_participants = len(correct_counts)
+    positions = np.tile(np.arange(responses_per_participant), num_participants)
+    correct = positions < np.repeat(correct_counts, responses_per_participant)
+    num_rows = len(positions)
+    return ResponseTable.build(
+        participant_index=np.repeat(np.arange(num_participants), responses_per_participant),
+        block_index=positions // 20,
+        center_azimuth=np.zeros(num_rows),
+        true_azimuth=np.zeros(num_rows),
+        response_azimuth=np.where(correct, 0, 10),
+        true_index=np.full(num_rows, 2),
+        response_index=np.where(correct, 2, 3),
+        azimuth_choices=np.tile(choices, (num_rows, 1)),
+        filename=np.full(num_rows, "stim.wav"),
+    )
+
+
+def _get_flagged_participants(rule, table):
+    blocks = BlockIndex.of_table(table)
+    flags = np.zeros(int(blocks.participants.max()) + 1, dtype=bool)
+    np.logical_or.at(flags, blocks.participants, rule.evaluate(table, blocks))
+    return flags
+
+
+def test_below_chance_rule_flags_at_the_binomial_boundary():
+    # With 40 responses and five choices, P(correct <= 2) is 0.008 and P(correct <= 3) is 0.028
+    table = _get_center_table([2, 3, 8, 12])
+    flagged = _get_flagged_participants(BelowChanceRule(alpha=0.01), table)
+    assert flagged.tolist() == [True, False, False, False]
+    flagged = _get_flagged_participants(BelowChanceRule(alpha=0.05), table)
+    assert flagged.tolist() == [True, True, False, False]
+
+
+def test_below_chance_rule_rarely_flags_participants_at_chance():
+    rng = np.random.default_rng(0)
+    rule = BelowChanceRule()
+    table = _get_center_table(rng.binomial(40, 1 / len(choices), 2000))
+    assert _get_flagged_participants(rule, table).mean() <= rule.alpha
@@ -0,0 +1,44 @@
+import numpy as np
+
+from screening import RunLengthRule
+from study import Study
+
+
+def test_constructing_a_study_leaves_its_participants_unchanged(synthetic_participants):
+    tables = [participant.table for participant in synthetic_participants]
+    first = Study(synthetic_participants, [])
+    first_tables = [participant.table for participant in first.participants]
+    second = Study(synthetic_participants[::-1], [])
+    assert all(p.table is table for p, table in zip(synthetic_participants, tables))
+    assert all(p.table is table for p, table in zip(first.participants, first_tables))
+    assert np.shares_memory(first.participants[0].table.true_azimuth, first.responses.true_azimuth)
+    assert not np.shares_memory(
+        first.participants[0].table.true_azimuth, second.responses.true_azimuth
+    )
+    assert np.array_equal(
+        second.participants[0].table.participant_index, np.full(len(tables[-1]), 0)
+    )
+    assert np.array_equal(first.participants[-1].table.true_azimuth, tables[-1].true_azimuth)
+
+
+def test_without_flagged_leaves_the_screened_study_unchanged(synthetic_study):
+    participants = list(synthetic_study.participants)
+    tables = [participant.table for participant in participants]
+    responses = synthetic_study.responses
+    screening = synthetic_study.screen([RunLengthRule(max_run=3)])
+    filtered = synthetic_study.without_flagged()
+    assert 0 < filtered.count() < len(participants)
+    assert synthetic_study.participants == participants
+    assert all(p.table is table for p, table in zip(synthetic_study.participants, tables))
+    assert synthetic_study.responses is responses
+    assert synthetic_study.screening is screening
+    assert synthetic_study.exceptions == []
+
+
+def test_summary_only_reports_flags_when_screening_flagged_someone(synthetic_study, capsys):
+    synthetic_study.screen([])
+    synthetic_study.print_summary()
+    assert "Flagged" not in capsys.readouterr().out
+    synthetic_study.screen([RunLengthRule(max_run=3)])
+    synthetic_study.print_summary()
+    assert "Flagged" in capsys.readouterr().out
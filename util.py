@@ -1,5 +1,11 @@
-from functools import reduce
-from typing import List, Dict
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import replace
+from typing import List, Dict, Callable, Hashable, Any
+import hashlib
+import json
+
+import numpy as np
 
 
 def merge_distributions(distributions: List[Dict[int, int]], expected_keys=range(-40, 50, 10)):
@@ -21,22 +27,24 @@ def print_distribution(distribution: Dict[int, int]):
     print(" ".join(p.rjust(max_pair_length) for p in pairs))
 
 
-def flag_block(block):
-    running_resp_count = 0
-    running_resp = None
-    max_running_resp_count = 0
-    for resp in block.responses:
-        azimuth = resp.response_azimuth
-        if running_resp is None:
-            running_resp = azimuth
-        if running_resp == azimuth:
-            running_resp_count += 1
-        else:
-            max_running_resp_count = max(max_running_resp_count, running_resp_count)
-            running_resp_count = 1
-        running_resp = azimuth
-    max_running_resp_count = max(running_resp_count, max_running_resp_count)
-    return max_running_resp_count > 10
+def get_longest_runs(values: np.ndarray, group_ids: np.ndarray, num_groups: int):
+    # Longest run of equal consecutive values in each group, for rows ordered by group id. Runs
+    # start wherever the value or the group changes, so their lengths are one bincount.
+    values = np.asarray(values)
+    group_ids = np.asarray(group_ids)
+    longest = np.zeros(num_groups, dtype=int)
+    if not len(values):
+        return longest
+    run_starts = np.ones(len(values), dtype=bool)
+    run_starts[1:] = (values[1:] != values[:-1]) | (group_ids[1:] != group_ids[:-1])
+    run_lengths = np.bincount(np.cumsum(run_starts) - 1)
+    np.maximum.at(longest, group_ids[run_starts], run_lengths)
+    return longest
+
+
+def flag_block(block, max_run=10):
+    values = block.table.response_azimuth
+    return bool(get_longest_runs(values, np.zeros(len(values), dtype=int), 1)[0] > max_run)
 
 
 def resolve_compensation_value(slowdown, compensation_descriptor):
@@ -48,4 +56,65 @@ def resolve_compensation_value(slowdown, compensation_descriptor):
 
 
 def mean_of_matrices(mats):
-    return reduce(lambda a, b: a + b, mats) / len(mats)
\ No newline at end of file
+    # One reduction over the stacked matrices rather than an intermediate sum per matrix
+    return np.sum(np.stack(mats), axis=0) / len(mats)
+
+
+class BoundedCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        value = compute()
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@contextmanager
+def atomic_output_path(output_path, suffix=".tmp"):
+    # Yields a temporary path to write to, which replaces output_path once the block completes so
+    # readers never see a partial file
+    temp_path = f"{output_path}{suffix}"
+    yield temp_path
+    replace(temp_path, output_path)
+
+
+@contextmanager
+def atomic_open(output_path, mode="w"):
+    with atomic_output_path(output_path) as temp_path:
+        with open(temp_path, mode) as file:
+            yield file
+
+
+def read_json(json_path):
+    # None if the file is missing or unreadable, as for a manifest that was never written
+    try:
+        with open(json_path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(json_path, value):
+    with atomic_open(json_path) as file:
+        json.dump(value, file, indent=2, sort_keys=True)